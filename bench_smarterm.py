@@ -0,0 +1,397 @@
+"""SmarTerm benchmarks, run against a local stand-in for the Gemini API (no API key or network needed).
+
+    python bench_smarterm.py                                  # every benchmark, JSON lines on stdout
+    python bench_smarterm.py turn prompt --output bench_output.txt
+    python bench_smarterm.py throughput --output-mb 1024,4096 # multi-GB command output
+    python bench_smarterm.py --baseline previous.jsonl        # exit code 1 on regressions
+
+Each benchmark case runs in its own worker process, with a throw-away home directory (config.ini,
+caches and metrics never touch the user's) and its own peak-memory measurement.
+Every result is one JSON object per line: {"benchmark", "case", "params", "results", ...}.
+"""
+import argparse
+import configparser
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource # Peak RSS (not available on Windows)
+except ImportError:
+    resource = None
+
+BENCHMARKS = ("turn", "throughput", "prompt")
+
+# Settings written to the worker's config.ini: no rate limiting, caching or suggestion shortcuts,
+# so every turn reaches the (fake) API; short backoffs so injected errors stay cheap.
+BASE_SETTINGS = {
+    "AI": {"WARM_UP": "false", "STREAMING": "false", "BACKGROUND": "true"},
+    "CACHE": {"ENABLED": "false"},
+    "SUGGESTIONS": {"ENABLED": "false"},
+    "METRICS": {"ENABLED": "false"},
+    "RATE_LIMIT": {"REQUESTS_PER_MINUTE": "0", "MAX_RETRIES": "5", "BACKOFF_BASE_SECONDS": "0.05", "BACKOFF_MAX_SECONDS": "0.2"},
+}
+
+# Results where lower is better, compared against --baseline
+REGRESSION_KEYS = ("p50", "p95", "mean", "seconds", "peak_rss_mb", "cold_ms", "warm_ms")
+# Results where higher is better (a drop means a feature silently stopped working)
+HIGHER_IS_BETTER_KEYS = ("cached_tokens",)
+
+# --- Faux backend Gemini ---
+class FakeResponse:
+    """Minimal GenerateContentResponse: text, usage metadata and prompt feedback."""
+
+    def __init__(self, text: str, prompt_chars: int, cached_chars: int = 0):
+        self.text = text
+        self.prompt_feedback = None
+        self.usage_metadata = type("Usage", (), {
+            "prompt_token_count": (prompt_chars + cached_chars) // 4, "candidates_token_count": len(text) // 4 + 1,
+            "cached_content_token_count": cached_chars // 4,
+        })()
+
+class FakeCaches:
+    """client.caches: remembers the size of each cached prefix."""
+
+    def __init__(self):
+        self.sizes = {}
+
+    def create(self, model: str, config) -> object:
+        name = f"cachedContents/bench-{len(self.sizes)}"
+        self.sizes[name] = len(str(config.system_instruction or "")) + sum(len(str(part)) for part in config.contents or [])
+        return type("CachedContent", (), {"name": name, "usage_metadata": None})()
+
+    def update(self, name: str, config) -> None:
+        pass
+
+    def delete(self, name: str) -> None:
+        self.sizes.pop(name, None)
+
+class FakeGeminiClient:
+    """Stand-in for genai.Client: canned replies after a configurable latency, optionally streamed,
+    with a configurable share of requests failing (RESOURCE_EXHAUSTED by default).
+    """
+
+    def __init__(self, reply: str = "CMD: echo benchmark", latency: float = 0.0, chunk_size: int = 8,
+                 chunk_interval: float = 0.0, error_rate: float = 0.0, error_code: int = 429,
+                 error_status: str = "RESOURCE_EXHAUSTED", seed: int = 0, latency_per_1k_tokens: float = 0.0):
+        self.models = self # client.models.generate_content(...)
+        self.caches = FakeCaches()
+        self.latency_per_1k_tokens = latency_per_1k_tokens # Time to process uncached input
+        self.reply = reply
+        self.latency = latency
+        self.chunk_size = max(chunk_size, 1)
+        self.chunk_interval = chunk_interval
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.error_status = error_status
+        self.calls = 0
+        self.errors = 0
+        self.prompt_chars = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _start_request(self, contents: list, config) -> tuple[str, int, int]:
+        import smarterm
+        prompt_chars = sum(len(part) for part in contents)
+        cached_chars = self.caches.sizes.get(getattr(config, "cached_content", None), 0)
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += prompt_chars
+            failing = self._random.random() < self.error_rate
+            if failing:
+                self.errors += 1
+        time.sleep(self.latency + prompt_chars / 4000 * self.latency_per_1k_tokens)
+        if failing:
+            error_class = smarterm.genai.errors.ServerError if self.error_code >= 500 else smarterm.genai.errors.ClientError
+            raise error_class(self.error_code, {"error": {"code": self.error_code, "message": "Injected by the benchmark.", "status": self.error_status}})
+        # ASK queries get the configured reply, explanations and analyses a plain text one
+        text = self.reply if str(contents[-1]).startswith(("User (ASK)", "Assistant (Instruction)")) else "The command printed a benchmark line."
+        return text, prompt_chars, cached_chars
+
+    def generate_content(self, model: str, contents: list, config=None) -> FakeResponse:
+        return FakeResponse(*self._start_request(contents, config))
+
+    def generate_content_stream(self, model: str, contents: list, config=None):
+        text, prompt_chars, cached_chars = self._start_request(contents, config)
+        for start in range(0, len(text), self.chunk_size):
+            if start:
+                time.sleep(self.chunk_interval)
+            yield FakeResponse(text[start:start + self.chunk_size], prompt_chars, cached_chars)
+
+def install_fake_client(**options) -> FakeGeminiClient:
+    """Imports smarterm (from the isolated home) and routes its AI requests to a FakeGeminiClient."""
+    import smarterm
+    smarterm._import_genai() # Real SDK error classes, so retries behave as in production
+    fake = FakeGeminiClient(**options)
+    smarterm._client = fake
+    return fake
+
+# --- Mesures ---
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1) # Bytes on macOS, KiB elsewhere
+
+def summarize(values: list) -> dict:
+    import smarterm
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "p50": round(smarterm.percentile(values, 0.5), 5),
+        "p95": round(smarterm.percentile(values, 0.95), 5),
+        "mean": round(sum(values) / len(values), 5),
+    }
+
+# --- Benchmarks (exécutés dans un processus worker) ---
+SINGLE_MODEL = {"ASK": "models/gemini-2.5-flash", "EXPLANATION": "models/gemini-2.5-flash", "ERROR_ANALYSIS": "models/gemini-2.5-flash"}
+TURN_CASES = {
+    # name: (mode, settings overrides, fake client options)
+    "execute": ("EXECUTE", {}, {}),
+    "execute-foreground": ("EXECUTE", {"AI": {"BACKGROUND": "false"}}, {}),
+    "ask": ("ASK", {}, {}),
+    "ask-stream": ("ASK", {"AI": {"STREAMING": "true"}}, {"chunk_interval": 0.01}),
+    # One model per task: an injected 429 cannot fall back to another model, so it is retried with backoff
+    "ask-resource-exhausted": ("ASK", {"MODELS": SINGLE_MODEL}, {"error_rate": 0.3}),
+    "ask-server-error": ("ASK", {}, {"error_rate": 0.3, "error_code": 500, "error_status": "INTERNAL"}),
+    "ask-text-stream": ("ASK", {"AI": {"STREAMING": "true"}}, {"reply": "Use `ls -la` to list hidden files. " * 8, "chunk_interval": 0.01}),
+    # Long sessions: each turn adds ~1.5 KB of output to the history (uncompressed: seq's lines
+    # would otherwise collapse to a few bytes); input costs time to process
+    "ask-long-session": ("ASK", {"AI": {"STREAMING": "true"}, "OUTPUT": {"COMPRESS": "false"}},
+                         {"reply": "CMD: seq 1 400", "latency_per_1k_tokens": 0.02}),
+    "ask-long-session-context-cache": ("ASK", {"AI": {"STREAMING": "true"}, "OUTPUT": {"COMPRESS": "false"},
+                                               "CONTEXT_CACHE": {"ENABLED": "true", "MIN_TOKENS": "256"}},
+                                       {"reply": "CMD: seq 1 400", "latency_per_1k_tokens": 0.02}),
+}
+
+def bench_turn(case: str, turns: int, latency: float) -> dict:
+    """End-to-end REPL turns through main(), with scripted input in place of the prompt."""
+    import smarterm
+    from rich.console import Console
+    mode, _, client_options = TURN_CASES[case]
+    fake = install_fake_client(latency=latency, **client_options)
+    script = ["!!"] if mode == "ASK" else []
+    for turn in range(turns):
+        # ASK turns also answer the command confirmation prompt (Enter)
+        script.extend([f"print benchmark line {turn}", ""] if mode == "ASK" else [f"echo benchmark {turn}"])
+    script.append("exit")
+    inputs = iter(script)
+    smarterm.Prompt.ask = lambda *args, **kwargs: next(inputs)
+    smarterm.console = Console(file=open(os.devnull, "w"), force_terminal=False)
+    smarterm.main([])
+    return {
+        "turn": summarize(smarterm.metrics.values("turn", "seconds")),
+        "ai": summarize(smarterm.metrics.values("ai", "latency")),
+        "first_token": summarize(smarterm.metrics.values("ai", "first_token")),
+        "retries": sum(attempts - 1 for attempts in smarterm.metrics.values("ai", "attempts")),
+        "input_tokens": sum(smarterm.metrics.values("ai", "input_tokens")),
+        "cached_tokens": sum(smarterm.metrics.values("ai", "cached_tokens")),
+        "api_calls": fake.calls,
+        "injected_errors": fake.errors,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_throughput(case: str, output_mb: float = 0, commands: int = 0) -> dict:
+    """execute_command on a command writing `output_mb` MiB of synthetic lines (or many tiny commands)."""
+    import smarterm
+    from rich.console import Console
+    smarterm.console = Console(file=open(os.devnull, "w"), force_terminal=False)
+    rss_before = peak_rss_mb()
+    if commands:
+        started_at = time.perf_counter()
+        for index in range(commands):
+            smarterm.execute_command(f"echo {index}")
+        seconds = time.perf_counter() - started_at
+        return {"seconds": round(seconds, 4), "commands_per_second": round(commands / seconds, 1), "peak_rss_mb": peak_rss_mb()}
+    size = int(output_mb * 1024 * 1024)
+    line = "benchmark output line with some padding to look like a build log 0123456789"
+    command = f"{sys.executable} -c \"import sys; line = {line!r} + chr(10); n = {size} // len(line); [sys.stdout.write(line * 1024) for _ in range(n // 1024)]; sys.stdout.write(line * (n % 1024))\""
+    started_at = time.perf_counter()
+    stdout, stderr, return_code = smarterm.execute_command(command)
+    seconds = time.perf_counter() - started_at
+    return {
+        "seconds": round(seconds, 4),
+        "mb_per_second": round(len(stdout) / (1024 * 1024) / seconds, 2),
+        "captured_bytes": len(stdout),
+        "spilled": stdout.spilled,
+        "return_code": return_code,
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_before_mb": rss_before,
+        "render_seconds": round(sum(smarterm.metrics.values("command", "render_seconds")), 4),
+    }
+
+def bench_prompt(case: str, entries: int, output_kb: float) -> dict:
+    """Cost of get_ai_response (history packing, prompt assembly) as the command history grows."""
+    import smarterm
+    fake = install_fake_client()
+    output = ("drwxr-xr-x  2 user user 4096 Jan  1 00:00 directory\n" * int(output_kb * 1024 / 52 + 1))[:int(output_kb * 1024)]
+    history = [
+        smarterm.HistoryEntry(user_command=f"ls -la /tmp/dir{index}", stdout=smarterm.OutputCapture.from_text(output), stderr="", return_code=0)
+        for index in range(entries)
+    ]
+    started_at = time.perf_counter()
+    smarterm.get_ai_response("list the biggest files", history, stream=False)
+    cold = time.perf_counter() - started_at
+    warm = []
+    for _ in range(20):
+        started_at = time.perf_counter()
+        smarterm.get_ai_response("list the biggest files", history, stream=False)
+        warm.append(time.perf_counter() - started_at)
+    return {
+        "cold_ms": round(cold * 1000, 3),
+        "warm_ms": round(smarterm.percentile(warm, 0.5) * 1000, 3),
+        "prompt_chars": fake.prompt_chars // fake.calls,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def worker_cases(args: argparse.Namespace) -> list[tuple[str, str, dict]]:
+    """(benchmark, case, params) for every case selected on the command line."""
+    cases = []
+    if "turn" in args.benchmarks:
+        cases.extend(("turn", case, {"turns": args.turns, "latency": args.latency}) for case in TURN_CASES)
+    if "throughput" in args.benchmarks:
+        for shell in ("session", "subprocess"):
+            cases.extend((("throughput", f"{shell}-{output_mb:g}mb", {"output_mb": output_mb}) for output_mb in args.output_mb))
+            cases.append(("throughput", f"{shell}-small-commands", {"commands": args.small_commands}))
+    if "prompt" in args.benchmarks:
+        cases.extend(("prompt", f"history-{entries}", {"entries": entries, "output_kb": args.output_kb}) for entries in args.history)
+    return cases
+
+def run_worker(benchmark: str, case: str, params: dict, result_path: str) -> None:
+    """Worker process entry point: isolated home and config.ini, then one benchmark case."""
+    home = tempfile.mkdtemp(prefix="smarterm-bench-")
+    os.environ["HOME"] = os.environ["USERPROFILE"] = home
+    settings = configparser.ConfigParser()
+    settings.optionxform = str
+    settings.read_dict(BASE_SETTINGS)
+    if benchmark == "turn":
+        settings.read_dict(TURN_CASES[case][1])
+    elif benchmark == "throughput":
+        settings.read_dict({"SHELL": {"PERSISTENT": str(case.startswith("session")).lower()}})
+    os.makedirs(os.path.join(home, "smarterm"))
+    with open(os.path.join(home, "smarterm", "config.ini"), "w", encoding="utf-8") as config_file:
+        settings.write(config_file)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    function = {"turn": bench_turn, "throughput": bench_throughput, "prompt": bench_prompt}[benchmark]
+    results = function(case, **params)
+    with open(result_path, "w", encoding="utf-8") as result_file:
+        json.dump(results, result_file)
+
+def run_case(benchmark: str, case: str, params: dict) -> dict:
+    """Runs one case in a fresh worker process (its output is discarded) and returns its result record."""
+    record = {"benchmark": benchmark, "case": case, "params": params}
+    with tempfile.TemporaryDirectory() as directory:
+        result_path = os.path.join(directory, "result.json")
+        started_at = time.perf_counter()
+        worker = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", benchmark, case, json.dumps(params), result_path],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        )
+        record["wall_seconds"] = round(time.perf_counter() - started_at, 3)
+        if worker.returncode == 0 and os.path.exists(result_path):
+            with open(result_path, encoding="utf-8") as result_file:
+                record["results"] = json.load(result_file)
+        else:
+            record["error"] = (worker.stderr.strip().splitlines() or [f"worker exited with code {worker.returncode}"])[-1]
+    return record
+
+def _flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def find_regressions(records: list[dict], baseline_path: str, tolerance: float) -> list[str]:
+    """Compares results with a previous run; returns one message per regression."""
+    baseline = {}
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        for line in baseline_file:
+            if line.strip():
+                previous = json.loads(line)
+                baseline[(previous["benchmark"], previous["case"])] = _flatten(previous.get("results", {}))
+    regressions = []
+    for record in records:
+        previous = baseline.get((record["benchmark"], record["case"]))
+        if previous is None:
+            continue
+        for key, value in _flatten(record.get("results", {})).items():
+            old = previous.get(key)
+            name = key.rsplit(".", 1)[-1]
+            if name in REGRESSION_KEYS and old and value > old * (1 + tolerance):
+                regressions.append(f"{record['benchmark']}/{record['case']} {key}: {old} -> {value} (+{100 * (value / old - 1):.0f}%)")
+            elif name in HIGHER_IS_BETTER_KEYS and old and value < old * (1 - tolerance):
+                regressions.append(f"{record['benchmark']}/{record['case']} {key}: {old} -> {value} ({100 * (value / old - 1):.0f}%)")
+    return regressions
+
+def _number_list(kind):
+    return lambda text: [kind(item) for item in text.split(",") if item]
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark SmarTerm against a local fake Gemini backend.")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--output", metavar="FILE", help="append JSON lines to this file instead of stdout")
+    parser.add_argument("--turns", type=int, default=20, help="REPL turns per turn case (default: 20)")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake API latency in seconds (default: 0.2)")
+    parser.add_argument("--output-mb", type=_number_list(float), default=[1, 64], metavar="MB[,MB...]", help="synthetic command output sizes in MiB (default: 1,64)")
+    parser.add_argument("--small-commands", type=int, default=50, help="number of tiny commands for the small-commands case (default: 50)")
+    parser.add_argument("--history", type=_number_list(int), default=[10, 100, 1000, 5000], metavar="N[,N...]", help="history lengths for the prompt benchmark (default: 10,100,1000,5000)")
+    parser.add_argument("--output-kb", type=float, default=2, help="output size of each history entry in KiB (default: 2)")
+    parser.add_argument("--baseline", metavar="FILE", help="previous results to compare with; exits with code 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a result counts as a regression (default: 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    return args
+
+def main(argv: list[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--worker"]:
+        benchmark, case, params, result_path = argv[1:5]
+        run_worker(benchmark, case, json.loads(params), result_path)
+        return 0
+
+    args = parse_args(argv)
+    output = open(args.output, "a", encoding="utf-8") if args.output else sys.stdout
+    environment = {
+        "timestamp": round(time.time(), 3), "python": platform.python_version(), "platform": platform.platform(),
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None,
+    }
+    records = []
+    try:
+        for benchmark, case, params in worker_cases(args):
+            print(f"[bench] {benchmark}/{case}...", file=sys.stderr, flush=True)
+            record = {**run_case(benchmark, case, params), **environment}
+            records.append(record)
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    failed = [record for record in records if "error" in record]
+    for record in failed:
+        print(f"[bench] {record['benchmark']}/{record['case']} failed: {record['error']}", file=sys.stderr)
+    if args.baseline:
+        regressions = find_regressions(records, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"[bench] regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,42 @@
+import time
+_process_started_at = time.perf_counter() # Reference point for --startup-profile
 import subprocess
 import sys
 import os
 import platform # Ajout de l'import platform
-import google.genai as genai
+import atexit
+import codecs
+import hashlib
+import json
+import math
+import mmap
+import sqlite3
+import tempfile
+import queue
+import random
+import re
+import secrets
+import shutil
+import signal
+import threading
+import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from typing import NamedTuple
 import configparser
 from rich.console import Console # Import Rich Console
 from rich.prompt import Prompt # Import Rich Prompt pour un input stylisé
+from rich.markup import escape
 
 # --- Initialisation Rich Console ---
 console = Console()
+console_stderr = Console(file=sys.stderr, style="bold red") # Colored output for stderr
 
 # --- Configuration ---
 # Construire le chemin par défaut vers config.ini dans le dossier utilisateur
-default_config_path = os.path.join(os.path.expanduser('~'), 'smarterm', 'config.ini')
+smarterm_home = os.path.join(os.path.expanduser('~'), 'smarterm')
+default_config_path = os.path.join(smarterm_home, 'config.ini')
 
 def load_api_key(config_file=default_config_path) -> str | None:
     """Loads the Gemini API key from a configuration file.
@@ -43,16 +67,141 @@ def load_api_key(config_file=default_config_path) -> str | None:
          console.print(f"[bold red]Unexpected error[/bold red] reading '[cyan]{config_file}[/cyan]': {e}")
          return None
 
-# --- Initialisation du client API ---
-api_key = load_api_key()
-if not api_key:
-    sys.exit(1)
+# Paramètres optionnels de config.ini (lus une seule fois, valeurs par défaut si absents)
+_settings = None
 
-try:
-    client = genai.Client(api_key=api_key)
-except Exception as e:
-    console.print(f"[bold red]Error[/bold red] initializing Gemini client with the provided key: {e}")
-    sys.exit(1)
+def load_settings(config_file=default_config_path) -> configparser.ConfigParser:
+    """Loads the optional tuning sections of the configuration file.
+    Read once; a missing file or option simply falls back to the defaults given by callers.
+    """
+    global _settings
+    if _settings is None:
+        _settings = configparser.ConfigParser()
+        _settings.read(config_file) # Silently ignores a missing file
+    return _settings
+
+# --- Instrumentation (latences, tokens, durées des phases) ---
+class SessionMetrics:
+    """Collects timings of the session's phases (AI requests, commands, REPL turns) in memory
+    and appends them to a JSONL metrics file ([METRICS] in config.ini).
+    """
+
+    def __init__(self, path: str, enabled: bool = True):
+        self.path = os.path.expanduser(path)
+        self.enabled = enabled
+        self.session_id = secrets.token_hex(4)
+        self.events = deque(maxlen=10000)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, **fields) -> None:
+        event = {"ts": round(time.time(), 3), "session": self.session_id, "kind": kind, **fields}
+        with self._lock:
+            self.events.append(event)
+            if not self.enabled:
+                return
+            try:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self._file = open(self.path, "a", encoding='utf-8')
+                self._file.write(json.dumps(event) + "\n")
+                self._file.flush()
+            except OSError:
+                self.enabled = False # Keep the in-memory metrics only
+
+    def values(self, kind: str, field: str, **match) -> list:
+        """Returns the non-null values of `field` for this session's events of `kind` matching `match`."""
+        with self._lock:
+            events = list(self.events)
+        return [
+            event[field] for event in events
+            if event["kind"] == kind and event.get(field) is not None
+            and all(event.get(key) == value for key, value in match.items())
+        ]
+
+def percentile(values: list, fraction: float) -> float | None:
+    """Nearest-rank percentile (None for an empty list)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+metrics = SessionMetrics(
+    load_settings().get('METRICS', 'FILE', fallback=os.path.join(smarterm_home, 'metrics.jsonl')),
+    enabled=load_settings().getboolean('METRICS', 'ENABLED', fallback=True),
+)
+
+# --- Initialisation du client API (différée jusqu'au premier appel IA) ---
+# google.genai est importé à la demande : le mode EXECUTE ne paie ni l'import du SDK ni la lecture de la clé
+genai = None
+_client = None
+_client_error = None # AIUnavailableError of the first failed creation, raised again without retrying
+_client_lock = threading.Lock()
+startup_phases = [] # (phase, seconds) pairs reported by --startup-profile
+
+class AIUnavailableError(Exception):
+    """Raised when the Gemini client cannot be created (missing SDK, key or invalid configuration)."""
+
+def _import_genai():
+    """Imports the Gemini SDK on first use and returns the module."""
+    global genai
+    if genai is None:
+        try:
+            import google.genai as genai_module
+        except ImportError as e:
+            raise AIUnavailableError(f"The google-genai package is not installed ({e}).")
+        genai = genai_module
+    return genai
+
+def get_client():
+    """Returns the shared Gemini client, importing the SDK and reading the API key on first use.
+    A failure is remembered: the setup instructions are printed once, later calls fail right away.
+    """
+    global _client, _client_error
+    with _client_lock:
+        if _client_error is not None:
+            raise _client_error
+        if _client is None:
+            try:
+                _client = _create_client()
+            except AIUnavailableError as e:
+                _client_error = e
+                raise
+        return _client
+
+def _create_client():
+    sdk = _import_genai()
+    api_key = load_api_key()
+    if not api_key:
+        raise AIUnavailableError("Gemini API key not configured.")
+    timeout_seconds = load_settings().getfloat('RATE_LIMIT', 'REQUEST_TIMEOUT_SECONDS', fallback=60)
+    try:
+        # A single client (and its pooled HTTP connections) is shared by every AI request
+        return sdk.Client(api_key=api_key, http_options=sdk.types.HttpOptions(timeout=int(timeout_seconds * 1000)))
+    except Exception as e:
+        console.print(f"[bold red]Error[/bold red] initializing Gemini client with the provided key: {e}")
+        raise AIUnavailableError("Could not initialize the Gemini client.")
+
+def ai_available() -> bool:
+    """False once creating the client has failed: automatic explanations and analyses are then skipped."""
+    return _client_error is None
+
+def _warm_up_client() -> None:
+    """Imports the SDK and builds the client in the background while the banner prints."""
+    started_at = time.perf_counter()
+    try:
+        _import_genai()
+        # Only build the client if a key is present: configuration errors are reported by the first AI call
+        if load_settings().get('API', 'GEMINI_API_KEY', fallback=None):
+            get_client()
+    except Exception:
+        pass
+    startup_phases.append(("Gemini SDK + client warm-up (background)", time.perf_counter() - started_at))
+
+def start_client_warm_up() -> None:
+    """Starts the optional background warm-up ([AI] WARM_UP in config.ini, on by default)."""
+    if load_settings().getboolean('AI', 'WARM_UP', fallback=True):
+        threading.Thread(target=_warm_up_client, daemon=True).start()
 
 # --- Génération dynamique du Prompt Système --- 
 def get_system_prompt() -> str:
@@ -110,76 +259,1580 @@ def get_user_confirmation(command: str) -> tuple[bool, str]:
         console.print(f"\n[magenta][SYSTEM][/magenta] Command cancelled. You can ask for a correction.")
         return False, "" # No command to execute
 
-def execute_command(command: str) -> tuple[str, str, int]:
-    """Executes the command and returns stdout, stderr, and return code, with Rich display."""
-    stdout_lines = []
-    stderr_lines = []
+# --- Moteur d'E/S des commandes ---
+# Taille des blocs lus sur les pipes (lecture par gros blocs plutôt que ligne par ligne)
+READ_CHUNK_SIZE = 64 * 1024
+
+class OutputChunk(NamedTuple):
+    """A block of output read from one of the command's pipes."""
+    timestamp: float # Seconds elapsed since the command started
+    stream: str      # 'stdout' or 'stderr'
+    text: str
+
+def _pump_fd(fd: int, stream_name: str, events: queue.Queue) -> None:
+    """Reads a pipe (or pty master) in large chunks until EOF and forwards them to the event queue.
+    A final (stream_name, None) event signals that the pipe is closed.
+    """
     try:
-        console.print(f"[blue]--- Executing: [bold]{command}[/bold] ---[/blue]")
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace')
-
-        # Read stdout with Rich
-        if process.stdout:
-            for line in process.stdout:
-                line_content = line.strip()
-                console.print(f"[dim]OUT>[/dim] {line_content}") # 'dim' style for standard output
-                stdout_lines.append(line_content)
-            process.stdout.close()
-
-        # Read stderr with Rich
-        if process.stderr:
-            # Create a specific console for stderr for colored output
-            console_stderr = Console(file=sys.stderr, style="bold red")
-            for line in process.stderr:
-                line_content = line.strip()
-                # Print to stderr via the dedicated console
-                console_stderr.print(f"ERR> {line_content}")
-                stderr_lines.append(line_content)
-            process.stderr.close()
-
-        process.wait()
-        returncode = process.returncode
+        while True:
+            data = os.read(fd, READ_CHUNK_SIZE)
+            if not data:
+                break
+            events.put((time.monotonic(), stream_name, data))
+    except (OSError, ValueError):
+        pass # Pipe closed underneath us: treat as EOF
+    finally:
+        events.put((time.monotonic(), stream_name, None))
+
+def stream_process_output(process: subprocess.Popen, on_chunk) -> None:
+    """Drains stdout and stderr of a process concurrently, one reader thread per pipe,
+    so that neither pipe can fill up and block the child.
+    Chunks are decoded incrementally and passed to on_chunk(OutputChunk) in arrival order.
+    """
+    events = queue.Queue()
+    started_at = time.monotonic()
+    decoders = {}
+    for stream_name in ("stdout", "stderr"):
+        pipe = getattr(process, stream_name)
+        if pipe is None:
+            continue
+        decoders[stream_name] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        threading.Thread(target=_pump_fd, args=(pipe.fileno(), stream_name, events), daemon=True).start()
+
+    open_pipes = len(decoders)
+    while open_pipes:
+        timestamp, stream_name, data = events.get()
+        if data is None:
+            open_pipes -= 1
+            text = decoders[stream_name].decode(b"", final=True)
+        else:
+            text = decoders[stream_name].decode(data)
+        if text:
+            on_chunk(OutputChunk(timestamp - started_at, stream_name, text))
+
+# --- Session shell persistante ---
+# Boucle exécutée par le shell de session : lit "<marqueur> <commande encodée>" sur un descripteur dédié,
+# l'évalue dans le shell courant (cd, export, venv persistent) puis encadre la fin avec le marqueur.
+# La commande est encodée sur une ligne (\\ et \n échappés) et décodée par printf %b.
+# Ctrl+C : le shell survit (trap), mais la commande entière est abandonnée (retour de la fonction,
+# comme un shell neuf tué par SIGINT) au lieu de passer à la suite de `make build; make deploy`.
+SESSION_DRIVER = """
+__smarterm_run() {
+    eval "$(printf '%b' "$1")" {fd}<&-
+}
+trap ':' INT
+while IFS=' ' read -r __smarterm_marker __smarterm_command <&{fd}; do
+    trap 'return 130' INT
+    __smarterm_run "$__smarterm_command"
+    __smarterm_status=$?
+    trap ':' INT
+    printf '%s:%s\\n' "$__smarterm_marker" "$__smarterm_status"
+    printf '%s\\n' "$__smarterm_marker" >&2
+done
+"""
+
+class ShellSessionError(Exception):
+    """Raised when the persistent shell cannot run a command (it died or timed out)."""
+
+    def __init__(self, message: str, return_code: int = -1):
+        super().__init__(message)
+        self.return_code = return_code
+
+def _descendant_pids(pid: int) -> list[int]:
+    """Lists the descendants of a process (Linux /proc, best effort)."""
+    descendants = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as handle:
+                for child in handle.read().split():
+                    descendants.append(int(child))
+                    descendants.extend(_descendant_pids(int(child)))
+    except (OSError, ValueError):
+        pass
+    return descendants
+
+class ShellSession:
+    """A long-lived shell (bash or zsh) that runs every command, so state such as the working
+    directory, exported variables or an activated venv carries over between commands.
+
+    Commands are sent on a dedicated pipe; their stdout (a pty where possible) and stderr are
+    pumped by persistent reader threads, and each command's end and exit code are framed by a
+    unique sentinel. Commands keep the terminal as stdin, as with a fresh shell per command.
+    """
+
+    def __init__(self, shell: str, use_pty: bool = True, timeout: float = 0):
+        self.shell = shell
+        self.use_pty = use_pty
+        self.timeout = timeout # Seconds, 0 = no limit
+        self.process = None
+        self._token = secrets.token_hex(8)
+        self._counter = 0
+
+    def start(self) -> None:
+        command_read, self._command_write = os.pipe()
+        stdout_target = subprocess.PIPE
+        stdout_master = None
+        env = dict(os.environ)
+        if self.use_pty:
+            import pty, termios, fcntl, struct
+            stdout_master, stdout_slave = pty.openpty()
+            attributes = termios.tcgetattr(stdout_slave)
+            attributes[1] &= ~termios.ONLCR # Keep plain \n line endings
+            termios.tcsetattr(stdout_slave, termios.TCSANOW, attributes)
+            size = shutil.get_terminal_size()
+            fcntl.ioctl(stdout_slave, termios.TIOCSWINSZ, struct.pack("HHHH", size.lines, size.columns, 0, 0))
+            stdout_target = stdout_slave
+            # stdout looks like a terminal: keep pagers from waiting for input, whatever the user's settings
+            env.update(PAGER="cat", MANPAGER="cat", GIT_PAGER="cat", SYSTEMD_PAGER="cat")
+        try:
+            self.process = subprocess.Popen(
+                [self.shell, "-c", SESSION_DRIVER.replace("{fd}", str(command_read)), "smarterm"],
+                stdout=stdout_target, stderr=subprocess.PIPE, pass_fds=(command_read,), env=env,
+            )
+        finally:
+            os.close(command_read)
+            if stdout_master is not None:
+                os.close(stdout_slave)
+        self._events = queue.Queue()
+        self._decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace') for name in ("stdout", "stderr")}
+        stdout_fd = stdout_master if stdout_master is not None else self.process.stdout.fileno()
+        self._stdout_master = stdout_master
+        for fd, stream_name in ((stdout_fd, "stdout"), (self.process.stderr.fileno(), "stderr")):
+            threading.Thread(target=_pump_fd, args=(fd, stream_name, self._events), daemon=True).start()
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, command: str, on_chunk) -> int:
+        """Runs one command in the session, passing its output to on_chunk(OutputChunk); returns its exit code.
+        Raises ShellSessionError if the shell exits or the command times out (the session is then closed).
+        """
+        self._counter += 1
+        marker = f"__SMARTERM_{self._token}_{self._counter}__"
+        encoded = command.replace("\\", "\\\\").replace("\n", "\\n")
+        started_at = time.monotonic()
+        os.write(self._command_write, f"{marker} {encoded}\n".encode('utf-8'))
+
+        pending = {"stdout": "", "stderr": ""}
+        finished = {"stdout": False, "stderr": False}
+        return_code = None
+        interrupted = False
+        deadline = started_at + self.timeout if self.timeout else None
+        while not all(finished.values()):
+            try:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    timestamp, stream_name, data = self._events.get(timeout=wait)
+                except queue.Empty:
+                    self.close()
+                    if interrupted:
+                        break # The command ignored Ctrl+C: the session was killed instead
+                    raise ShellSessionError(f"timed out after {self.timeout:g}s")
+                if data is None: # The shell itself exited
+                    exit_code = self.process.wait()
+                    self.close()
+                    raise ShellSessionError(f"exited with code {exit_code}", exit_code)
+                text = pending[stream_name] + self._decoders[stream_name].decode(data)
+                index = text.find(marker)
+                if index == -1:
+                    # Hold back a possible partial marker at the end of the chunk
+                    keep = next((k for k in range(min(len(marker) - 1, len(text)), 0, -1) if marker.startswith(text[-k:])), 0)
+                    output, pending[stream_name] = text[:len(text) - keep], text[len(text) - keep:]
+                else:
+                    output, rest = text[:index], text[index + len(marker):]
+                    if stream_name == "stdout":
+                        if "\n" not in rest:
+                            output, pending[stream_name] = text[:index], text[index:] # Exit code line not complete yet
+                            text = None
+                        else:
+                            return_code = int(rest.split("\n", 1)[0].lstrip(":") or 0)
+                    if text is not None:
+                        pending[stream_name] = ""
+                        finished[stream_name] = True
+                if output:
+                    on_chunk(OutputChunk(timestamp - started_at, stream_name, output))
+            except KeyboardInterrupt:
+                # Ctrl+C reached the command too; the shell survives it (trap), abandons the rest of the
+                # command line and still prints the sentinel
+                interrupted = True
+                deadline = time.monotonic() + 3
+        if interrupted:
+            raise KeyboardInterrupt
+        return return_code
+
+    def close(self) -> None:
+        """Stops the shell (and whatever it is running)."""
+        if self.process is None:
+            return
+        try:
+            os.close(self._command_write) # EOF ends the driver loop
+        except OSError:
+            pass
+        if self.process.poll() is None:
+            for pid in [*_descendant_pids(self.process.pid), self.process.pid]:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            self.process.wait()
+        if self._stdout_master is not None:
+            try:
+                os.close(self._stdout_master)
+            except OSError:
+                pass
+        self.process = None
+
+_shell_session = None
+_shell_session_restarts = 0
+_shell_session_disabled = False # Set after too many restarts
+
+def _session_shell() -> str | None:
+    """Picks the session shell: $SHELL if it is bash or zsh, otherwise bash if installed."""
+    user_shell = os.environ.get("SHELL", "")
+    if os.path.basename(user_shell) in ("bash", "zsh") and os.path.exists(user_shell):
+        return user_shell
+    return shutil.which("bash")
+
+def get_shell_session() -> ShellSession | None:
+    """Returns the running persistent shell, starting (or restarting) it if needed.
+    Returns None when persistent mode is disabled ([SHELL] PERSISTENT), unsupported (Windows,
+    no bash/zsh) or after too many restarts; commands then run in a fresh shell each.
+    """
+    global _shell_session, _shell_session_restarts, _shell_session_disabled
+    settings = load_settings()
+    if _shell_session_disabled or os.name != "posix" or not settings.getboolean('SHELL', 'PERSISTENT', fallback=True):
+        return None
+    if _shell_session is not None and _shell_session.alive():
+        return _shell_session
+    if _shell_session is not None:
+        _shell_session_restarts += 1
+        if _shell_session_restarts > settings.getint('SHELL', 'MAX_RESTARTS', fallback=5):
+            console.print("[magenta][SYSTEM][/magenta] Too many shell session restarts, running each command in a fresh shell.")
+            _shell_session_disabled = True
+            _shell_session = None
+            return None
+        console.print("[magenta][SYSTEM][/magenta] Starting a new shell session (working directory and variables were reset).")
+    shell = _session_shell()
+    if shell is None:
+        return None
+    session = ShellSession(
+        shell,
+        use_pty=settings.getboolean('SHELL', 'USE_PTY', fallback=True),
+        timeout=settings.getfloat('SHELL', 'COMMAND_TIMEOUT_SECONDS', fallback=0),
+    )
+    try:
+        session.start()
+    except OSError as e:
+        console.print(f"[magenta][SYSTEM][/magenta] Could not start a persistent shell ({e}), running each command in a fresh shell.")
+        return None
+    _shell_session = session
+    return session
+
+@atexit.register
+def _close_shell_session() -> None:
+    if _shell_session is not None:
+        _shell_session.close()
+
+# --- Capture bornée de la sortie ---
+# Au-delà de ce plafond, seuls le début et la fin restent en mémoire, le flux complet part sur disque
+DEFAULT_CAPTURE_MAX_BYTES = 512 * 1024
+
+class OutputCapture:
+    """Bounded capture of one output stream of a command.
+
+    Up to max_bytes are kept in memory. Past that cap, the full stream is spilled to an
+    anonymous temporary file and only the head and tail (max_bytes / 2 each) stay in memory.
+    History entries and prompts hold a reference to the capture; str() gives the bounded text.
+    The spill file is closed by release() once the history has stored the output.
+    """
+
+    def __init__(self, max_bytes: int | None = None):
+        if max_bytes is None:
+            max_bytes = load_settings().getint('OUTPUT', 'CAPTURE_MAX_BYTES', fallback=DEFAULT_CAPTURE_MAX_BYTES)
+        self.max_bytes = max(max_bytes, 2)
+        self.size = 0 # Total bytes written, including the part only kept on disk
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._spill = None
+
+    @classmethod
+    def from_text(cls, text: str, max_bytes: int | None = None) -> "OutputCapture":
+        capture = cls(max_bytes)
+        capture.write(text)
+        return capture
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
+
+    def write(self, text: str) -> None:
+        data = text.encode('utf-8', errors='replace')
+        self.size += len(data)
+        half = self.max_bytes // 2
+        if self._spill is None:
+            self._head += data
+            if len(self._head) <= self.max_bytes:
+                return
+            # Cap exceeded: move the whole stream to disk, keep head and tail in memory
+            self._spill = tempfile.TemporaryFile(prefix='smarterm-')
+            self._spill.write(self._head)
+            self._tail = self._head[-half:]
+            del self._head[half:]
+            return
+        self._spill.write(data)
+        self._tail += data
+        if len(self._tail) > self.max_bytes: # Trim lazily to keep appends amortized
+            del self._tail[:-half]
+
+    def text(self) -> str:
+        """Returns the captured text, with the middle elided if the stream was spilled."""
+        if self.size == len(self._head):
+            return self._head.decode('utf-8', errors='replace')
+        half = self.max_bytes // 2
+        omitted = self.size - len(self._head) - len(self._tail[-half:])
+        return (
+            f"{self._head.decode('utf-8', errors='ignore')}"
+            f"\n[... {omitted} bytes omitted ...]\n"
+            f"{self._tail[-half:].decode('utf-8', errors='ignore')}"
+        )
+
+    def view(self):
+        """Returns a read-only bytes-like view of the full stream (memory-mapped if spilled).
+        Once the spill file is released, only the head and tail are left to view."""
+        if self._spill is None:
+            return memoryview(self.text().encode('utf-8') if self.size > len(self._head) else bytes(self._head))
+        self._spill.flush()
+        return mmap.mmap(self._spill.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def release(self) -> None:
+        """Closes the spill file, keeping only the head and tail in memory (text() is unchanged)."""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            del self._tail[:-(self.max_bytes // 2)]
+
+    def full_text(self) -> str:
+        """Returns the complete stream, reading it back from disk if needed."""
+        if self._spill is None:
+            return self.text()
+        with self.view() as mapped:
+            return mapped[:].decode('utf-8', errors='replace')
+
+    def __str__(self) -> str:
+        return self.text()
+
+    def __bool__(self) -> bool:
+        return self.size > 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __repr__(self) -> str:
+        return f"OutputCapture(size={self.size}, spilled={self.spilled})"
+
+# --- Affichage de la sortie des commandes ---
+DEFAULT_RENDER_INTERVAL_MS = 50
+DEFAULT_COLLAPSE_AFTER_LINES = 2000
+DEFAULT_COLLAPSE_TAIL_LINES = 20
+
+class OutputRenderer:
+    """Displays the output of a running command in batched writes.
+
+    Output goes straight to the consoles' files, never through Rich markup, so brackets in the
+    output are shown verbatim. Writes are grouped and flushed at most every `interval` seconds
+    (a timer flushes whatever is left when the command goes quiet).
+    mode "styled" prefixes each line with OUT>/ERR>; "raw" passes chunks through unchanged.
+    Past collapse_after lines (0 = never), display stops: a counter is kept and the last
+    tail_lines lines are shown when the command ends. Captures are not affected.
+    """
+
+    def __init__(self, mode: str = "styled", interval: float = DEFAULT_RENDER_INTERVAL_MS / 1000,
+                 collapse_after: int = DEFAULT_COLLAPSE_AFTER_LINES, tail_lines: int = DEFAULT_COLLAPSE_TAIL_LINES):
+        self.raw = mode == "raw"
+        self.interval = interval
+        self.collapse_after = collapse_after
+        self.files = {"stdout": console.file, "stderr": console_stderr.file}
+        self.prefixes = {
+            "stdout": ("\x1b[2mOUT>\x1b[0m ", "") if self._colored(console) else ("OUT> ", ""),
+            "stderr": ("\x1b[1;31mERR> ", "\x1b[0m") if self._colored(console_stderr) else ("ERR> ", ""),
+        }
+        self.lines_shown = 0
+        self.lines_hidden = 0
+        self.bytes_hidden = 0
+        self.render_seconds = 0.0
+        self._tail = deque(maxlen=max(tail_lines, 0))
+        self._pending = {"stdout": "", "stderr": ""} # Partial (not yet newline-terminated) line per stream
+        self._batch = [] # (stream, text) in arrival order, not yet written
+        self._flushed_at = 0.0
+        self._timer = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _colored(target: Console) -> bool:
+        return target.is_terminal and not target.no_color and target.color_system is not None
+
+    @property
+    def full(self) -> bool:
+        """True once collapse_after lines were shown: further lines are only counted."""
+        return 0 < self.collapse_after <= self.lines_shown
+
+    def _format(self, stream_name: str, line: str) -> str:
+        if self.raw:
+            return line + "\n"
+        start, end = self.prefixes[stream_name]
+        return f"{start}{line.rstrip(chr(13))}{end}\n"
+
+    def feed(self, stream_name: str, text: str) -> None:
+        with self._lock:
+            if self.raw and not self.full:
+                self._feed_raw(stream_name, text)
+            else:
+                self._feed_lines(stream_name, text)
+            if time.monotonic() - self._flushed_at >= self.interval:
+                self._flush()
+            elif self._batch and self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _feed_lines(self, stream_name: str, text: str) -> None:
+        *lines, self._pending[stream_name] = (self._pending[stream_name] + text).split("\n")
+        for line in lines:
+            self._add_line(stream_name, line)
+
+    def _feed_raw(self, stream_name: str, text: str) -> None:
+        newlines = text.count("\n")
+        room = self.collapse_after - self.lines_shown if self.collapse_after > 0 else newlines + 1
+        if newlines < room:
+            # Written as is; a partial last line is remembered only to terminate it at the end
+            self._batch.append((stream_name, text))
+            self.lines_shown += newlines
+            self._pending[stream_name] = text[text.rfind("\n") + 1:] if newlines else self._pending[stream_name] + text
+            return
+        # The collapse threshold is reached inside this chunk: show up to it, count the rest
+        cut = -1
+        for _ in range(room):
+            cut = text.index("\n", cut + 1)
+        self._batch.append((stream_name, text[:cut + 1]))
+        self.lines_shown += room
+        self._pending[stream_name] = ""
+        self._feed_lines(stream_name, text[cut + 1:])
+
+    def _add_line(self, stream_name: str, line: str) -> None:
+        if not self.full:
+            self._batch.append((stream_name, self._format(stream_name, line)))
+            self.lines_shown += 1
+            return
+        if not self.lines_hidden:
+            self._batch.append(("stdout", f"... output collapsed after {self.lines_shown} lines, the end is shown when the command finishes ...\n"))
+        self.lines_hidden += 1
+        self.bytes_hidden += len(line) + 1
+        self._tail.append((stream_name, line))
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+        started_at = time.perf_counter()
+        # Consecutive writes to the same stream are joined into one
+        runs = []
+        for stream_name, text in self._batch:
+            if runs and runs[-1][0] == stream_name:
+                runs[-1][1].append(text)
+            else:
+                runs.append((stream_name, [text]))
+        self._batch = []
+        for stream_name, parts in runs:
+            target = self.files[stream_name]
+            target.write("".join(parts))
+            target.flush()
+        self._flushed_at = time.monotonic()
+        self.render_seconds += time.perf_counter() - started_at
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        """Writes the last unterminated lines and, if output was collapsed, its summary and tail."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for stream_name, rest in self._pending.items():
+                if rest:
+                    if self.raw and not self.full:
+                        self._batch.append((stream_name, "\n")) # The partial line itself was already written
+                    else:
+                        self._add_line(stream_name, rest)
+                    self._pending[stream_name] = ""
+            if self.lines_hidden:
+                shown = len(self._tail)
+                skipped_bytes = self.bytes_hidden - sum(len(line) + 1 for _, line in self._tail)
+                self._batch.append(("stdout", f"... {self.lines_hidden - shown} lines ({skipped_bytes} bytes) not shown, last {shown} lines: ...\n"))
+                self._batch.extend((stream_name, self._format(stream_name, line)) for stream_name, line in self._tail)
+            self._flush()
+
+def create_output_renderer() -> OutputRenderer:
+    """Builds a renderer from [OUTPUT] RENDER_MODE, RENDER_INTERVAL_MS, COLLAPSE_AFTER_LINES and COLLAPSE_TAIL_LINES."""
+    settings = load_settings()
+    return OutputRenderer(
+        mode=settings.get('OUTPUT', 'RENDER_MODE', fallback="styled").strip().lower(),
+        interval=settings.getint('OUTPUT', 'RENDER_INTERVAL_MS', fallback=DEFAULT_RENDER_INTERVAL_MS) / 1000,
+        collapse_after=settings.getint('OUTPUT', 'COLLAPSE_AFTER_LINES', fallback=DEFAULT_COLLAPSE_AFTER_LINES),
+        tail_lines=settings.getint('OUTPUT', 'COLLAPSE_TAIL_LINES', fallback=DEFAULT_COLLAPSE_TAIL_LINES),
+    )
+
+def execute_command(command: str, transcript: list | None = None, on_output=None) -> tuple[OutputCapture, OutputCapture, int]:
+    """Executes the command and returns stdout, stderr (as bounded OutputCapture), and return code, with Rich display.
+    stdout and stderr are pumped concurrently; if a transcript list is given, it receives
+    every OutputChunk in its real interleaved order. on_output(chunk, captures) is called
+    for every chunk while the command runs.
+    """
+    captures = {"stdout": OutputCapture(), "stderr": OutputCapture()}
+    renderer = create_output_renderer()
+    started_at = time.perf_counter()
+
+    def on_chunk(chunk: OutputChunk) -> None:
+        captures[chunk.stream].write(chunk.text)
+        if transcript is not None:
+            transcript.append(chunk)
+        if on_output is not None:
+            on_output(chunk, captures)
+        renderer.feed(chunk.stream, chunk.text)
+
+    try:
+        console.print(f"[blue]--- Executing: [bold]{escape(command)}[/bold] ---[/blue]")
+        session = get_shell_session()
+        if session is not None:
+            # Persistent shell: state (cd, export, venv...) carries over between commands
+            try:
+                returncode = session.run(command, on_chunk)
+            except ShellSessionError as e:
+                on_chunk(OutputChunk(0.0, "stderr", f"smarterm: shell session {e}.\n"))
+                returncode = e.return_code
+        else:
+            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stream_process_output(process, on_chunk)
+            process.wait()
+            returncode = process.returncode
+
+        # Last unterminated lines, and the end of collapsed output
+        renderer.close()
+
+        metrics.record(
+            "command", seconds=round(time.perf_counter() - started_at, 4), render_seconds=round(renderer.render_seconds, 4),
+            stdout_bytes=len(captures["stdout"]), stderr_bytes=len(captures["stderr"]), return_code=returncode,
+        )
         status_style = "green" if returncode == 0 else "red"
         console.print(f"[blue]--- Command finished (code: [{status_style}]{returncode}[/{status_style}]) ---[/blue]")
-        return "\n".join(stdout_lines), "\n".join(stderr_lines), returncode
+        return captures["stdout"], captures["stderr"], returncode
 
     except Exception as e:
         error_msg = f"Error executing command: {e}"
+        renderer.close()
         # Print the exception error to stderr as well
-        console_stderr_except = Console(file=sys.stderr, style="bold red")
-        console_stderr_except.print(f"ERR> {error_msg}")
-        return "", error_msg, -1
+        console_stderr.print(f"ERR> {escape(error_msg)}")
+        return captures["stdout"], OutputCapture.from_text(error_msg), -1
+    finally:
+        renderer.close() # Also on Ctrl+C, so no flush timer fires after the prompt is back
+
+# --- Réponses en streaming ---
+def ai_streaming_enabled() -> bool:
+    """Returns whether AI replies are streamed token by token ([AI] STREAMING in config.ini, on by default)."""
+    return load_settings().getboolean('AI', 'STREAMING', fallback=True)
+
+def stream_ai_text(model: str, contents: list, header: str, status_message: str, progress: dict | None = None, config=None) -> tuple[str, object]:
+    """Streams a Gemini reply and renders natural-language text under `header` as tokens arrive.
+
+    A reply starting with 'CMD:' is not rendered: the stream is cut as soon as the command
+    line is complete so the caller can go straight to confirmation.
+    Returns (text, last_chunk); API errors propagate as with generate_content.
+    progress["rendered"] is set once text has been shown (such a request cannot be retried).
+    """
+    status = console.status(status_message)
+    status.start()
+    buffer = ""
+    rendering = False
+    last_chunk = None
+    stream = get_client().models.generate_content_stream(model=model, contents=contents, config=config)
+    try:
+        for chunk in stream:
+            last_chunk = chunk
+            if not chunk.text:
+                continue
+            if progress is not None and "first_token_at" not in progress:
+                progress["first_token_at"] = time.perf_counter()
+            buffer += chunk.text
+            if rendering:
+                console.print(chunk.text, end="", markup=False, highlight=False)
+                continue
+            head = buffer.lstrip()
+            if head.startswith("CMD:"):
+                if "\n" in head:
+                    buffer = head.split("\n", 1)[0] # Command line complete, the rest is not needed
+                    break
+                continue
+            if "CMD:".startswith(head):
+                continue # Too short to tell a command from text yet
+            # Natural-language reply: start rendering
+            rendering = True
+            if progress is not None:
+                progress["rendered"] = True
+            status.stop()
+            console.print(header, end="")
+            console.print(head, end="", markup=False, highlight=False)
+        else:
+            if not rendering and buffer and not buffer.lstrip().startswith("CMD:"):
+                # Whole reply too short to start rendering ("C", "CMD", whitespace): show it now
+                rendering = True
+                if progress is not None:
+                    progress["rendered"] = True
+                status.stop()
+                console.print(header, end="")
+                console.print(buffer.strip(), end="", markup=False, highlight=False)
+    finally:
+        status.stop()
+        stream.close()
+        if rendering:
+            console.print()
+    return buffer, last_chunk
+
+# --- Historique de session (enregistrements compacts, journal sur disque) ---
+class HistoryBlob:
+    """Output of a past command kept in a blob file next to the session log, read on demand."""
+
+    __slots__ = ("path", "size")
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size # Size of the original output (the blob may only hold its head and tail)
+
+    def text(self, max_bytes: int | None = None) -> str:
+        """Returns the output, reading only its head and tail from disk if it is larger than max_bytes."""
+        if max_bytes is None:
+            max_bytes = load_settings().getint('OUTPUT', 'CAPTURE_MAX_BYTES', fallback=DEFAULT_CAPTURE_MAX_BYTES)
+        try:
+            with open(self.path, 'rb') as blob:
+                stored = os.fstat(blob.fileno()).st_size
+                if stored <= max_bytes:
+                    return blob.read().decode('utf-8', errors='replace')
+                half = max_bytes // 2
+                head = blob.read(half)
+                blob.seek(-half, os.SEEK_END)
+                tail = blob.read(half)
+        except OSError:
+            return f"[Output no longer available: {self.path}]"
+        return f"{head.decode('utf-8', errors='ignore')}\n[... {stored - 2 * half} bytes omitted ...]\n{tail.decode('utf-8', errors='ignore')}"
+
+    def full_text(self) -> str:
+        return self.text(max_bytes=sys.maxsize)
+
+    def __str__(self) -> str:
+        return self.text()
+
+    def __bool__(self) -> bool:
+        return self.size > 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __repr__(self) -> str:
+        return f"HistoryBlob({self.path!r}, size={self.size})"
+
+class HistoryEntry:
+    """One turn of the session history, as given to the AI as context.
+
+    EXECUTE turns set user_command; ASK turns set user_input and one of ai_command (with the
+    command outputs), ai_response, or ai_action + proposed_command. stdout/stderr are an
+    OutputCapture, a str, or a HistoryBlob once written to the session log.
+    """
+
+    __slots__ = ("timestamp", "user_input", "user_command", "ai_command", "ai_response", "ai_action",
+                 "proposed_command", "stdout", "stderr", "return_code", "prompt")
+    FIELDS = __slots__[:-1] # Persisted in the session log; prompt caches the formatted lines
+
+    def __init__(self, **fields):
+        unknown = fields.keys() - set(self.FIELDS)
+        if unknown:
+            raise TypeError(f"Unknown history fields: {', '.join(sorted(unknown))}")
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        if self.timestamp is None:
+            self.timestamp = round(time.time(), 3)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.FIELDS[1:] if getattr(self, name) is not None)
+        return f"HistoryEntry({fields})"
+
+class SessionLog:
+    """Append-only JSONL log of a session's history (~/smarterm/sessions/<session>.jsonl).
+
+    Outputs up to inline_max_bytes are written in the log line; larger ones go to a blob file
+    in the <session>/ directory (at most blob_max_bytes of head and tail) and are replaced in
+    the entry by a HistoryBlob, so the in-memory history never holds full outputs.
+    Logs hold full command outputs (secrets included): directories are created 0700, files 0600.
+    """
+
+    def __init__(self, path: str, inline_max_bytes: int = 2048, blob_max_bytes: int = 16 * 1024 * 1024):
+        self.path = path
+        self.blob_dir = os.path.splitext(path)[0]
+        self.inline_max_bytes = inline_max_bytes
+        self.blob_max_bytes = blob_max_bytes
+        self._file = None
+
+    @property
+    def name(self) -> str:
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def _store_output(self, value, stream_name: str):
+        """Returns (log value, value kept in the entry) for one output."""
+        if len(value) <= self.inline_max_bytes:
+            text = str(value)
+            return text, text
+        _make_private_dir(self.blob_dir)
+        blob_path = os.path.join(self.blob_dir, f"{secrets.token_hex(6)}.{stream_name}")
+        try:
+            with os.fdopen(os.open(blob_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as blob:
+                if isinstance(value, OutputCapture):
+                    with value.view() as data:
+                        if len(data) <= self.blob_max_bytes:
+                            blob.write(data)
+                        else: # Keep the head and tail, like HistoryBlob.text() does when reading back
+                            half = self.blob_max_bytes // 2
+                            blob.write(data[:half])
+                            blob.write(f"\n[... {len(data) - 2 * half} bytes omitted ...]\n".encode('utf-8'))
+                            blob.write(data[-half:])
+                elif isinstance(value, HistoryBlob):
+                    blob.write(value.text(self.blob_max_bytes).encode('utf-8', errors='replace'))
+                else:
+                    blob.write(str(value).encode('utf-8', errors='replace'))
+        except BaseException:
+            try:
+                os.remove(blob_path) # No empty or partial blob left behind
+            except OSError:
+                pass
+            raise
+        return {"blob": os.path.basename(blob_path), "bytes": len(value)}, HistoryBlob(blob_path, len(value))
+
+    def write(self, entry: HistoryEntry) -> None:
+        record = {}
+        for name in HistoryEntry.FIELDS:
+            value = getattr(entry, name)
+            if value is None:
+                continue
+            if name in ("stdout", "stderr"):
+                value, kept = self._store_output(value, name)
+                setattr(entry, name, kept)
+            record[name] = value
+        if self._file is None:
+            _make_private_dir(os.path.dirname(self.path))
+            self._file = os.fdopen(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "a", encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def read(self, limit: int | None = None) -> list[HistoryEntry]:
+        """Loads the last `limit` entries of the log; blobs are only referenced, not read."""
+        entries = deque(maxlen=limit)
+        with open(self.path, encoding='utf-8') as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Line cut by a crash
+                for name in ("stdout", "stderr"):
+                    if isinstance(record.get(name), dict):
+                        record[name] = HistoryBlob(os.path.join(self.blob_dir, record[name]["blob"]), record[name]["bytes"])
+                entries.append(HistoryEntry(**{name: value for name, value in record.items() if name in HistoryEntry.FIELDS}))
+        return list(entries)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class SessionHistory(list):
+    """The command history of the interactive session: a list of HistoryEntry whose appends are
+    also written to the session log. Only the last max_entries entries stay in memory (the log
+    keeps the rest), and only the most recent ones keep their formatted prompt text.
+    """
+
+    def __init__(self, entries=(), log: SessionLog | None = None, max_entries: int = 500, prompt_cache_entries: int = 200):
+        super().__init__(entries)
+        self.log = log
+        self.max_entries = max(max_entries, 1)
+        self.prompt_cache_entries = prompt_cache_entries
+        self.dropped = 0 # Entries removed from the front so far (positions are shifted by this much)
+        self._trim()
+
+    def _trim(self) -> None:
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            del self[:excess]
+            self.dropped += excess
+
+    def append(self, entry: HistoryEntry) -> None:
+        if self.log is not None:
+            try:
+                self.log.write(entry)
+            except Exception as e: # A logging failure must not end the session
+                console.print(f"[bold red]Error:[/bold red] Could not write the session log ({escape(str(e))}), history is no longer saved.")
+                self.log = None
+        for name in ("stdout", "stderr"):
+            value = getattr(entry, name)
+            if isinstance(value, OutputCapture):
+                value.release() # The full stream was only kept for the session log
+        super().append(entry)
+        self._trim()
+        if len(self) > self.prompt_cache_entries:
+            self[-self.prompt_cache_entries - 1].prompt = None # Re-rendered from the log if ever needed
+
+def sessions_dir() -> str:
+    return os.path.join(smarterm_home, 'sessions')
+
+def _make_private_dir(path: str) -> None:
+    """Creates a directory readable by the user only (and tightens it if it already exists)."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.stat(path).st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+def _make_private_file(path: str) -> None:
+    """Creates a file (and its directory) readable by the user only, tightening them if they exist.
+    Used for stores that may quote command output, such as the SQLite caches."""
+    _make_private_dir(os.path.dirname(path))
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+    if os.stat(path).st_mode & 0o077:
+        os.chmod(path, 0o600)
+
+def prune_sessions(keep_sessions: int, keep_days: float, current: str | None = None) -> None:
+    """Deletes the oldest session logs and their blobs beyond keep_sessions, or older than
+    keep_days (0 disables either limit). The current session is never deleted."""
+    directory = sessions_dir()
+    try:
+        logs = sorted((name for name in os.listdir(directory) if name.endswith('.jsonl')), reverse=True)
+    except OSError:
+        return
+    cutoff = time.time() - keep_days * 86400
+    kept = 1 if current is not None else 0
+    for name in logs:
+        path = os.path.join(directory, name)
+        if current is not None and os.path.abspath(path) == os.path.abspath(current):
+            continue
+        try:
+            expired = keep_days > 0 and os.path.getmtime(path) < cutoff
+            if not expired and (keep_sessions <= 0 or kept < keep_sessions):
+                kept += 1
+                continue
+            os.remove(path)
+        except OSError:
+            continue
+        shutil.rmtree(os.path.splitext(path)[0], ignore_errors=True)
+
+def find_session_log(session: str) -> str | None:
+    """Resolves --resume's argument: 'latest', a session name (or its start), or a log path."""
+    if os.path.isfile(session):
+        return session
+    try:
+        logs = sorted((name for name in os.listdir(sessions_dir()) if name.endswith('.jsonl')), reverse=True)
+    except OSError:
+        return None
+    if session != "latest":
+        logs = [name for name in logs if name.startswith(session)]
+    return os.path.join(sessions_dir(), logs[0]) if logs else None
+
+def open_session_history(resume: str | None = None) -> SessionHistory:
+    """Creates the session history, logged under ~/smarterm/sessions/ unless [HISTORY] LOG is off.
+    With resume, the last [HISTORY] MEMORY_ENTRIES entries of that session are restored and it is continued.
+    Sessions beyond [HISTORY] KEEP_SESSIONS, or older than KEEP_DAYS, are deleted in the background.
+    """
+    settings = load_settings()
+    max_entries = settings.getint('HISTORY', 'MEMORY_ENTRIES', fallback=500)
+    if not settings.getboolean('HISTORY', 'LOG', fallback=True):
+        if resume:
+            console.print("[magenta][SYSTEM][/magenta] Session logging is disabled ([HISTORY] LOG), nothing to resume.")
+        return SessionHistory(max_entries=max_entries)
+    options = {
+        "inline_max_bytes": settings.getint('HISTORY', 'INLINE_MAX_BYTES', fallback=2048),
+        "blob_max_bytes": settings.getint('HISTORY', 'BLOB_MAX_BYTES', fallback=16 * 1024 * 1024),
+    }
+    if resume:
+        path = find_session_log(resume)
+        if path is None:
+            console.print(f"[magenta][SYSTEM][/magenta] No session matching '{escape(resume)}' in {escape(sessions_dir())}, starting a new one.")
+        else:
+            log = SessionLog(path, **options)
+            try:
+                entries = log.read(max_entries)
+            except OSError as e:
+                console.print(f"[bold red]Error:[/bold red] Could not read {escape(path)}: {escape(str(e))}")
+            else:
+                console.print(f"[magenta][SYSTEM][/magenta] Resumed session [cyan]{escape(log.name)}[/cyan] ({len(entries)} entries).")
+                history = SessionHistory(entries, log, max_entries)
+                _start_session_pruning(settings, log.path)
+                return history
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{metrics.session_id}"
+    log = SessionLog(os.path.join(sessions_dir(), f"{name}.jsonl"), **options)
+    _start_session_pruning(settings, log.path)
+    return SessionHistory(log=log, max_entries=max_entries)
+
+def _start_session_pruning(settings, current: str) -> None:
+    threading.Thread(
+        target=prune_sessions,
+        args=(settings.getint('HISTORY', 'KEEP_SESSIONS', fallback=100), settings.getfloat('HISTORY', 'KEEP_DAYS', fallback=30), current),
+        name="smarterm-prune-sessions", daemon=True,
+    ).start()
+
+# --- Compression de la sortie avant envoi à l'IA ---
+ANSI_PATTERN = re.compile(r"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])")
+CONTROL_PATTERN = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+BACKSPACE_PATTERN = re.compile(r"[^\x08\n]\x08")
+# Lines never collapsed or sampled away (near-duplicates of them are kept too)
+IMPORTANT_LINE_PATTERN = re.compile(
+    r"(?i)\b(error|errors|fatal|exception|traceback|failed|failure|panic|denied|cannot|critical|warning|warn)\b"
+    r"|^\s*(File \"|at \S+\(|E\s{2,}|-->\s)"
+)
+VARIABLE_PARTS_PATTERN = re.compile(r"(?i)0x[0-9a-f]+|[0-9a-f]{8,}|\d+(?:[.:,/]\d+)*")
+DEFAULT_COLLAPSE_MIN_RUN = 4
+DEFAULT_TABLE_MIN_ROWS = 20
+DEFAULT_TABLE_SAMPLE_ROWS = 12
+
+class CompressedOutput(NamedTuple):
+    text: str
+    original_bytes: int
+    saved_bytes: int
+
+def clean_terminal_text(text: str) -> str:
+    """Removes ANSI escape sequences and control characters, keeping what a terminal would show:
+    the last state of \r-redrawn lines (progress bars) and the result of backspaces.
+    """
+    text = ANSI_PATTERN.sub("", text.replace("\r\n", "\n"))
+    while "\b" in text:
+        cleaned = BACKSPACE_PATTERN.sub("", text)
+        if cleaned == text:
+            break
+        text = cleaned
+    lines = []
+    for line in text.split("\n"):
+        if "\r" in line:
+            line = next((part for part in reversed(line.split("\r")) if part), "")
+        lines.append(CONTROL_PATTERN.sub("", line))
+    return "\n".join(lines)
+
+def _important_lines(lines: list[str]) -> list[bool]:
+    """Flags error-relevant lines, including every line of Python tracebacks."""
+    important = []
+    in_traceback = False
+    for line in lines:
+        if line.startswith("Traceback (most recent call last)"):
+            in_traceback = True
+        elif in_traceback and line and not line[0].isspace():
+            important.append(True) # The exception line ends the traceback
+            in_traceback = False
+            continue
+        important.append(in_traceback or bool(IMPORTANT_LINE_PATTERN.search(line)))
+    return important
+
+def _collapse_runs(lines: list[str], important: list[bool], min_run: int) -> list[tuple[str, bool]]:
+    """Collapses identical lines into one with a count, and runs of near-identical lines
+    (same text once numbers and hashes are masked) into their first and last line."""
+    result = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        end = index + 1
+        while end < len(lines) and lines[end] == line:
+            end += 1
+        if end - index > 1:
+            result.append((line if not line.strip() else f"{line}  [repeated {end - index} times]", important[index]))
+            index = end
+            continue
+        if not important[index]:
+            skeleton = VARIABLE_PARTS_PATTERN.sub("#", line.strip())
+            while end < len(lines) and not important[end] and VARIABLE_PARTS_PATTERN.sub("#", lines[end].strip()) == skeleton:
+                end += 1
+            if end - index >= min_run and skeleton:
+                result.append((line, False))
+                result.append((f"[... {end - index - 2} similar lines ...]", False))
+                result.append((lines[end - 1], False))
+                index = end
+                continue
+        result.append((line, important[index]))
+        index += 1
+    return result
+
+def _sample_tables(lines: list[tuple[str, bool]], min_rows: int, sample_rows: int) -> list[str]:
+    """Keeps the header, first, last and evenly spaced rows (plus error rows) of long tables:
+    runs of lines with the same number (at least 2) of whitespace-separated columns, give or
+    take 2 for wide rows (e.g. `ls -l` symlinks, names with spaces)."""
+    result = []
+    index = 0
+    while index < len(lines):
+        columns = len(lines[index][0].split())
+        slack = 2 if columns >= 5 else 0
+        end = index + 1
+        while columns >= 2 and end < len(lines) and abs(len(lines[end][0].split()) - columns) <= slack:
+            end += 1
+        if end - index < max(min_rows, sample_rows + 2):
+            result.extend(line for line, _ in lines[index:end])
+            index = end
+            continue
+        rows = end - index
+        edge = sample_rows // 3
+        step = max((rows - 2 * edge) // max(sample_rows - 2 * edge, 1), 1)
+        keep = set(range(edge + 1)) | set(range(rows - edge, rows)) | set(range(edge, rows - edge, step))
+        keep |= {offset for offset in range(rows) if lines[index + offset][1]}
+        skipped = 0
+        for offset in range(rows):
+            if offset in keep:
+                if skipped:
+                    result.append(f"[... {skipped} of {rows} table rows omitted ...]")
+                    skipped = 0
+                result.append(lines[index + offset][0])
+            else:
+                skipped += 1
+        index = end
+    return result
+
+def compress_output(output, min_run: int = DEFAULT_COLLAPSE_MIN_RUN, table_min_rows: int = DEFAULT_TABLE_MIN_ROWS,
+                    table_sample_rows: int = DEFAULT_TABLE_SAMPLE_ROWS) -> CompressedOutput:
+    """Shrinks command output for a prompt: control sequences removed, repeated and near-duplicate
+    lines collapsed with counts, long tables sampled; error lines and tracebacks are kept intact."""
+    text = str(output) if output else ""
+    original_bytes = len(text.encode('utf-8', errors='replace'))
+    lines = clean_terminal_text(text).split("\n")
+    collapsed = _collapse_runs(lines, _important_lines(lines), min_run)
+    compressed = "\n".join(_sample_tables(collapsed, table_min_rows, table_sample_rows)).strip()
+    return CompressedOutput(compressed, original_bytes, max(original_bytes - len(compressed.encode('utf-8', errors='replace')), 0))
+
+def output_for_prompt(output) -> str:
+    """Returns a command output as sent to the AI, compressed unless [OUTPUT] COMPRESS is off."""
+    settings = load_settings()
+    if not output:
+        return ""
+    if not settings.getboolean('OUTPUT', 'COMPRESS', fallback=True):
+        return str(output).strip()
+    result = compress_output(
+        output,
+        min_run=settings.getint('OUTPUT', 'COLLAPSE_MIN_RUN', fallback=DEFAULT_COLLAPSE_MIN_RUN),
+        table_min_rows=settings.getint('OUTPUT', 'TABLE_MIN_ROWS', fallback=DEFAULT_TABLE_MIN_ROWS),
+        table_sample_rows=settings.getint('OUTPUT', 'TABLE_SAMPLE_ROWS', fallback=DEFAULT_TABLE_SAMPLE_ROWS),
+    )
+    metrics.record("compression", original_bytes=result.original_bytes, saved_bytes=result.saved_bytes)
+    return result.text
+
+# --- Historique envoyé à l'IA, borné par un budget de tokens ---
+DEFAULT_HISTORY_TOKEN_BUDGET = 8000
+DEFAULT_HISTORY_OUTPUT_MAX_TOKENS = 1000
+CHARS_PER_TOKEN = 4 # Rough average for Gemini tokenizers on English text and shell output
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (no API round trip)."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _head_tail(text: str, max_tokens: int) -> str:
+    """Shrinks text to its head and tail if it exceeds max_tokens."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    half = max_chars // 2
+    return f"{text[:half]}\n[... {len(text) - 2 * half} characters omitted ...]\n{text[-half:]}"
+
+def format_history_entry(entry: HistoryEntry, output_max_tokens: int) -> tuple[list[str], int]:
+    """Formats one history entry as prompt lines and returns them with their token estimate.
+    The result is cached in the entry, so older entries are not re-rendered on every ASK.
+    """
+    cached = entry.prompt
+    if cached and cached[0] == output_max_tokens:
+        return cached[1], cached[2]
+
+    def outputs() -> str:
+        stdout_part = f"\nOutput:\n```\n{_head_tail(output_for_prompt(entry.stdout), output_max_tokens)}\n```" if entry.stdout else ""
+        stderr_part = f"\nErrors:\n```\n{_head_tail(output_for_prompt(entry.stderr), output_max_tokens)}\n```" if entry.stderr else ""
+        return f"{stdout_part}{stderr_part}"
+
+    lines = []
+    if entry.user_input is not None: # User query in ASK mode
+        lines.append(f"User (ASK): {entry.user_input}")
+
+    if entry.ai_command is not None:
+        # AI responded with a command (after an ASK query)
+        lines.append(f"Assistant (CMD:{entry.ai_command}):{outputs()}\nReturn Code: {entry.return_code}")
+    elif entry.ai_response is not None:
+        # AI responded with text (after an ASK query)
+        lines.append(f"Assistant (TEXT): {entry.ai_response}")
+    elif entry.ai_action is not None and entry.proposed_command is not None:
+        # Action cancelled by user (after an ASK query)
+        lines.append(f"Assistant: (Action cancelled by user: Proposal was 'CMD:{entry.proposed_command}')")
+    elif entry.user_command is not None: # Command executed directly in EXECUTE mode
+        lines.append(f"User (EXECUTE CMD:{entry.user_command}):{outputs()}\nReturn Code: {entry.return_code}")
+
+    tokens = sum(estimate_tokens(line) for line in lines)
+    entry.prompt = (output_max_tokens, lines, tokens)
+    return lines, tokens
+
+def build_history_prompt(history: list, token_budget: int | None = None) -> list[str]:
+    """Packs the most recent history entries into the token budget ([AI] HISTORY_TOKEN_BUDGET).
+    Stops at the first entry that does not fit, so the context sent stays contiguous.
+    """
+    settings = load_settings()
+    if token_budget is None:
+        token_budget = settings.getint('AI', 'HISTORY_TOKEN_BUDGET', fallback=DEFAULT_HISTORY_TOKEN_BUDGET)
+    output_max_tokens = settings.getint('AI', 'HISTORY_OUTPUT_MAX_TOKENS', fallback=DEFAULT_HISTORY_OUTPUT_MAX_TOKENS)
+
+    selected = []
+    used = 0
+    for entry in reversed(history):
+        lines, tokens = format_history_entry(entry, output_max_tokens)
+        if used + tokens > token_budget:
+            break
+        selected.append(lines)
+        used += tokens
+    return [line for lines in reversed(selected) for line in lines]
+
+# --- Couche commune des requêtes IA (timeouts, retries, limitation de débit) ---
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Overloaded, over quota or unknown model: the next model of the task is tried right away
+FALLBACK_STATUS_CODES = {404, 429, 503}
+
+class TokenBucket:
+    """Client-side rate limiter: rate_per_minute requests on average, bursts of up to `capacity`."""
+
+    def __init__(self, rate_per_minute: float, capacity: int):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(capacity, 1)
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel: threading.Event | None = None) -> float:
+        """Blocks until a request may be sent; returns the time spent waiting.
+        Raises RequestCancelled if `cancel` is set meanwhile."""
+        if self.rate <= 0:
+            return 0.0 # Rate limiting disabled
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            _sleep_unless_cancelled(delay, cancel)
+            waited += delay
+
+class RequestCancelled(Exception):
+    """Raised inside request_ai_text when a background request was cancelled while waiting."""
+
+def _sleep_unless_cancelled(delay: float, cancel: threading.Event | None) -> None:
+    if cancel is None:
+        time.sleep(delay)
+    elif cancel.wait(delay):
+        raise RequestCancelled()
+
+@contextmanager
+def _request_slot(concurrency: threading.BoundedSemaphore, cancel: threading.Event | None):
+    """Holds a [RATE_LIMIT] MAX_CONCURRENT slot; waiting for one gives up if the request is cancelled."""
+    if cancel is None:
+        concurrency.acquire()
+    else:
+        while not concurrency.acquire(timeout=0.1):
+            if cancel.is_set():
+                raise RequestCancelled()
+        if cancel.is_set():
+            concurrency.release()
+            raise RequestCancelled()
+    try:
+        yield
+    finally:
+        concurrency.release()
+
+_request_limits = None
+_request_limits_lock = threading.Lock()
+
+def _get_request_limits() -> tuple[TokenBucket, threading.BoundedSemaphore, threading.BoundedSemaphore]:
+    """Returns the shared rate limiter, concurrency limit ([RATE_LIMIT] in config.ini), and the
+    limit for background requests: one slot less, so a foreground request never waits behind them."""
+    global _request_limits
+    with _request_limits_lock:
+        if _request_limits is None:
+            settings = load_settings()
+            bucket = TokenBucket(
+                settings.getfloat('RATE_LIMIT', 'REQUESTS_PER_MINUTE', fallback=30),
+                settings.getint('RATE_LIMIT', 'BURST', fallback=5),
+            )
+            max_concurrent = max(settings.getint('RATE_LIMIT', 'MAX_CONCURRENT', fallback=4), 1)
+            concurrency = threading.BoundedSemaphore(max_concurrent)
+            background = threading.BoundedSemaphore(max(max_concurrent - 1, 1))
+            _request_limits = (bucket, concurrency, background)
+        return _request_limits
+
+def _retry_delay_hint(error) -> float | None:
+    """Extracts the server's retry hint (google.rpc.RetryInfo or Retry-After header), in seconds."""
+    details = getattr(error, 'details', None)
+    if isinstance(details, dict):
+        for item in details.get('error', {}).get('details', []) or []:
+            if isinstance(item, dict) and str(item.get('@type', '')).endswith('RetryInfo'):
+                match = re.match(r"([\d.]+)s", str(item.get('retryDelay', '')))
+                if match:
+                    return float(match.group(1))
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers:
+        try:
+            return float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, genai.errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    # Timeouts and dropped connections (httpx transport errors or their builtin counterparts)
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__module__.startswith('httpx')
 
-def get_ai_response(user_input: str, history: list = None, verbose: bool = True) -> str:
+def _should_fall_back(error: Exception) -> bool:
+    return isinstance(error, genai.errors.APIError) and error.code in FALLBACK_STATUS_CODES
+
+def request_ai_text(model: str, contents: list, label: str = "", stream: bool = False, header: str = "", status_message: str = "",
+                    empty_message: str = "Sorry, I could not generate a response. Check for potential safety blocks.",
+                    fallback_models: list | tuple = (), cache_prefix: int = 0, cancel: threading.Event | None = None) -> str:
+    """Sends one generation request through the shared client, with retries and rate limiting.
+
+    Retries use jittered exponential backoff and honor the server's retry hints; a streamed reply
+    that already started rendering is not retried. If the model is overloaded or over quota, the
+    request moves on to the next of fallback_models without waiting. The first cache_prefix items
+    of contents are stable between requests and may be served from a Gemini context cache.
+    Returns the reply text, or a formatted [AI_ERROR] message. label names the task in error
+    messages ('explanation', ...). A request given a `cancel` event is a background one: it leaves
+    a concurrency slot free for foreground requests, and once the event is set (the user moved
+    on) it stops waiting for the rate limiter, a slot or a retry.
+    """
+    for_label = f" for {label}" if label else ""
+    try:
+        client = get_client() # First AI call: imports the SDK and creates the client
+    except AIUnavailableError as e:
+        return f"[AI_ERROR]{e}"
+
+    settings = load_settings()
+    max_retries = settings.getint('RATE_LIMIT', 'MAX_RETRIES', fallback=3)
+    backoff_base = settings.getfloat('RATE_LIMIT', 'BACKOFF_BASE_SECONDS', fallback=1.0)
+    backoff_max = settings.getfloat('RATE_LIMIT', 'BACKOFF_MAX_SECONDS', fallback=30.0)
+    bucket, concurrency, background = _get_request_limits()
+    started_at = time.perf_counter()
+    attempt = 0
+    outcome = "error"
+    response = None
+    progress = {}
+    fallbacks = [fallback for fallback in fallback_models if fallback != model]
+    try:
+        while True:
+            attempt += 1
+            progress = {"rendered": False}
+            request_contents, config = contents, None
+            cache_name = context_cache.lookup(label or "ask", model, contents[:cache_prefix]) if cache_prefix else None
+            if cache_name:
+                request_contents, config = contents[cache_prefix:], genai.types.GenerateContentConfig(cached_content=cache_name)
+            bucket.acquire(cancel)
+            try:
+                with _request_slot(background, cancel) if cancel is not None else nullcontext(), _request_slot(concurrency, cancel):
+                    if stream:
+                        text, response = stream_ai_text(model, request_contents, header, status_message, progress, config)
+                    else:
+                        response = client.models.generate_content(model=model, contents=request_contents, config=config)
+                        text = response.text
+            except Exception as e:
+                if isinstance(e, RequestCancelled):
+                    raise
+                if config is not None and not progress["rendered"] and isinstance(e, genai.errors.APIError) and e.code in (400, 403, 404):
+                    # The cached prefix expired or was deleted: send the whole prompt from now on
+                    context_cache.invalidate(label or "ask", model)
+                    cache_prefix = 0
+                    continue
+                if fallbacks and not progress["rendered"] and _should_fall_back(e):
+                    if threading.current_thread() is threading.main_thread():
+                        console.print(f"[dim][SYSTEM] {escape(model)} unavailable ({escape(str(e.status or e.code))}), switching to {escape(fallbacks[0])}...[/dim]")
+                    model = fallbacks.pop(0)
+                    continue
+                if attempt > max_retries or progress["rendered"] or not _is_retryable(e):
+                    raise
+                hint = _retry_delay_hint(e)
+                delay = min(backoff_max, backoff_base * 2 ** (attempt - 1))
+                delay = max(hint or 0.0, random.uniform(delay / 2, delay)) # Jitter, never sooner than the server asks
+                if threading.current_thread() is threading.main_thread():
+                    console.print(f"[dim][SYSTEM] Gemini request failed ({escape(str(getattr(e, 'status', None) or type(e).__name__))}), retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries + 1})...[/dim]")
+                _sleep_unless_cancelled(delay, cancel)
+                continue
+
+            if text:
+                outcome = "ok"
+                return text.strip()
+            outcome = "empty"
+            # Use Rich to display debug feedback
+            console.print(f"[magenta][SYSTEM][/magenta] DEBUG - Prompt Feedback{f' ({label.title()})' if label else ''}:", getattr(response, 'prompt_feedback', None))
+            return f"[AI_ERROR]{empty_message}"
+
+    except RequestCancelled:
+        outcome = "cancelled"
+        return f"[AI_ERROR]Request{for_label} cancelled."
+
+    except genai.errors.ClientError as e:
+        # Specifically handle quota exhausted error
+        if "RESOURCE_EXHAUSTED" in str(e):
+            error_msg = f"Google Gemini API quota exceeded{for_label}. Please check your plan and billing details."
+            console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
+            return f"[AI_ERROR]{error_msg}"
+        # Other API client errors
+        console.print(f"[bold red]ERR>[/bold red] Gemini API client error{for_label}: {e}", style="bold red")
+        return f"[AI_ERROR]Communication error {f'for {label}' if label else 'with AI'} (Client)."
+
+    except Exception as e:
+        # Other generic exceptions (server errors after retries, timeouts...)
+        console.print(f"[bold red]ERR>[/bold red] Unexpected error during Gemini API call{for_label}: {e}", style="bold red")
+        return f"[AI_ERROR]Unexpected communication error with AI{for_label}."
+
+    finally:
+        usage = getattr(response, 'usage_metadata', None)
+        metrics.record(
+            "ai", label=label or "ask", model=model, latency=round(time.perf_counter() - started_at, 4),
+            first_token=round(progress["first_token_at"] - started_at, 4) if "first_token_at" in progress else None,
+            attempts=attempt, outcome=outcome,
+            input_tokens=getattr(usage, 'prompt_token_count', None),
+            output_tokens=getattr(usage, 'candidates_token_count', None),
+            cached_tokens=getattr(usage, 'cached_content_token_count', None),
+        )
+        if settings.getboolean('AI', 'SHOW_LATENCY', fallback=False) and threading.current_thread() is threading.main_thread():
+            console.print(f"[dim]AI {label or 'response'}: {time.perf_counter() - started_at:.2f}s ({attempt} attempt{'s' if attempt > 1 else ''})[/dim]")
+
+# --- Cache de contexte Gemini (préfixe stable des prompts) ---
+class ContextCacheManager:
+    """Keeps Gemini context caches (client.caches) for the stable prefix of prompts.
+
+    The prefix is the system prompt, plus for ASK queries a frozen block of older history
+    (see split_history). One cache is kept per task ("slot") and model: it is replaced when the
+    prefix changes (OS prompt, history block moved forward), its TTL is extended while it is
+    in use (caches of a model no longer used simply expire), and it is deleted at exit. Caches are created and refreshed in the background:
+    until one is ready, or when the prefix is too short to be cached, lookup() returns None
+    and the full prompt is sent as usual.
+    """
+
+    def __init__(self, enabled: bool = False, ttl_seconds: int = 900, min_tokens: int = 2048, history_prefix: bool = True):
+        self.enabled = enabled
+        self.ttl_seconds = max(ttl_seconds, 60)
+        self.min_tokens = min_tokens
+        self.history_prefix = enabled and history_prefix
+        self._handles = {} # (slot, model) -> {"key", "model", "name", "expires_at", "refreshing"}
+        self._failed = set() # Prefix keys the API refused to cache (too short, unsupported model...)
+        self._frozen = None # (id(history), start, end) of the history block in the cached prefix
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model: str, prefix: list) -> str:
+        return hashlib.sha256("\0".join([model, *map(str, prefix)]).encode('utf-8')).hexdigest()
+
+    def lookup(self, slot: str, model: str, prefix: list) -> str | None:
+        """Returns the name of a ready cache holding `prefix` for `model`, or None (creating one in the background)."""
+        if not self.enabled or not prefix:
+            return None
+        key = self._key(model, prefix)
+        now = time.time()
+        with self._lock:
+            handle = self._handles.get((slot, model))
+            if handle is not None and handle["key"] == key:
+                if handle["name"] is None or now >= handle["expires_at"] - 5:
+                    return None # Still being created, or about to expire
+                if handle["expires_at"] - now < self.ttl_seconds / 3 and not handle["refreshing"]:
+                    handle["refreshing"] = True
+                    threading.Thread(target=self._refresh, args=(handle,), daemon=True).start()
+                return handle["name"]
+            if key in self._failed or sum(estimate_tokens(str(part)) for part in prefix) < self.min_tokens:
+                return None
+            # New prefix for this task: build its cache, then drop the previous one
+            handle = {"key": key, "model": model, "name": None, "expires_at": 0.0, "refreshing": False}
+            previous = self._handles.get((slot, model))
+            self._handles[(slot, model)] = handle
+        threading.Thread(target=self._create, args=(handle, list(prefix), previous), daemon=True).start()
+        return None
+
+    def _create(self, handle: dict, prefix: list, previous: dict | None) -> None:
+        started_at = time.perf_counter()
+        try:
+            cached = get_client().caches.create(model=handle["model"], config=genai.types.CreateCachedContentConfig(
+                display_name="smarterm", system_instruction=prefix[0], contents=prefix[1:] or None, ttl=f"{self.ttl_seconds}s",
+            ))
+        except Exception as e:
+            with self._lock:
+                self._failed.add(handle["key"])
+            metrics.record("context_cache", action="failed", model=handle["model"], error=str(getattr(e, 'status', None) or type(e).__name__))
+            return
+        with self._lock:
+            handle["name"] = cached.name
+            handle["expires_at"] = time.time() + self.ttl_seconds
+            replaced = not any(current is handle for current in self._handles.values()) # Superseded while being created
+        metrics.record("context_cache", action="created", model=handle["model"], seconds=round(time.perf_counter() - started_at, 4),
+                       tokens=getattr(getattr(cached, 'usage_metadata', None), 'total_token_count', None))
+        if replaced:
+            self._delete(handle)
+        if previous is not None:
+            self._delete(previous)
+
+    def _refresh(self, handle: dict) -> None:
+        try:
+            get_client().caches.update(name=handle["name"], config=genai.types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+            handle["expires_at"] = time.time() + self.ttl_seconds
+            metrics.record("context_cache", action="refreshed", model=handle["model"])
+        except Exception:
+            pass # Expires on its own; a new cache is created on the next lookup after that
+        finally:
+            handle["refreshing"] = False
+
+    def _delete(self, handle: dict) -> None:
+        if handle.get("name") and handle["expires_at"] > time.time():
+            try:
+                get_client().caches.delete(name=handle["name"])
+            except Exception:
+                pass # Expires on its own
+
+    def invalidate(self, slot: str, model: str) -> None:
+        """Forgets the cache of a task and model (e.g. the API no longer knows it)."""
+        with self._lock:
+            handle = self._handles.pop((slot, model), None)
+            if handle is not None:
+                self._failed.add(handle["key"]) # Do not rebuild it for the same prefix
+        if handle is not None:
+            threading.Thread(target=self._delete, args=(handle,), daemon=True).start()
+
+    def split_history(self, history: list, token_budget: int | None = None, prefix_tokens: int = 0) -> tuple[list[str], list[str]]:
+        """Splits the history sent with an ASK query into a frozen block (cacheable) and the recent entries.
+
+        The frozen block is kept while it and the newer entries fit in the token budget; then it
+        moves forward to the most recent entries filling half the budget, leaving room to grow.
+        While the prefix is too short to be cached, its end moves forward to cover the recent entries
+        as soon as they make it reach min_tokens (prefix_tokens: the part of the prefix before the
+        history, i.e. the system prompt).
+        """
+        settings = load_settings()
+        if token_budget is None:
+            token_budget = settings.getint('AI', 'HISTORY_TOKEN_BUDGET', fallback=DEFAULT_HISTORY_TOKEN_BUDGET)
+        output_max_tokens = settings.getint('AI', 'HISTORY_OUTPUT_MAX_TOKENS', fallback=DEFAULT_HISTORY_OUTPUT_MAX_TOKENS)
+
+        def lines(entries: list) -> list[str]:
+            return [line for entry in entries for line in format_history_entry(entry, output_max_tokens)[0]]
+
+        offset = getattr(history, "dropped", 0) # A SessionHistory drops its oldest entries from memory
+        with self._lock:
+            frozen = self._frozen
+            if frozen is not None and frozen[0] == id(history) and offset <= frozen[1] and frozen[2] - offset <= len(history):
+                start, end = frozen[1] - offset, frozen[2] - offset
+                tokens = [format_history_entry(entry, output_max_tokens)[1] for entry in history[start:]]
+                if sum(tokens) <= token_budget:
+                    frozen_tokens = prefix_tokens + sum(tokens[:end - start])
+                    recent_tokens = sum(tokens[end - start:])
+                    if frozen_tokens >= self.min_tokens or frozen_tokens + recent_tokens < self.min_tokens:
+                        return lines(history[start:end]), lines(history[end:])
+                    self._frozen = (id(history), start + offset, len(history) + offset)
+                    return lines(history[start:]), []
+            start, used = len(history), 0
+            while start > 0:
+                tokens = format_history_entry(history[start - 1], output_max_tokens)[1]
+                if used + tokens > token_budget // 2:
+                    break
+                used += tokens
+                start -= 1
+            if start == len(history):
+                self._frozen = None # Nothing small enough to freeze: plain budgeted history
+                return [], build_history_prompt(history, token_budget)
+            self._frozen = (id(history), start + offset, len(history) + offset)
+        return lines(history[start:]), []
+
+    def close(self) -> None:
+        """Deletes the caches of this session (called at exit)."""
+        with self._lock:
+            handles, self._handles = list(self._handles.values()), {}
+        for handle in handles:
+            self._delete(handle)
+
+def _create_context_cache() -> ContextCacheManager:
+    settings = load_settings()
+    return ContextCacheManager(
+        enabled=settings.getboolean('CONTEXT_CACHE', 'ENABLED', fallback=False),
+        ttl_seconds=settings.getint('CONTEXT_CACHE', 'TTL_SECONDS', fallback=900),
+        min_tokens=settings.getint('CONTEXT_CACHE', 'MIN_TOKENS', fallback=2048),
+        history_prefix=settings.getboolean('CONTEXT_CACHE', 'HISTORY_PREFIX', fallback=True),
+    )
+
+context_cache = _create_context_cache()
+atexit.register(context_cache.close)
+
+# --- Choix du modèle par tâche (ASK, explication, analyse d'erreur) ---
+PRO_MODEL = 'models/gemini-2.5-pro-exp-03-25'
+FLASH_MODEL = 'models/gemini-2.5-flash'
+# Per task: the preferred model first, then the fallbacks used when it is overloaded or over quota
+DEFAULT_TASK_MODELS = {
+    "ask": (PRO_MODEL, FLASH_MODEL),
+    "explanation": (FLASH_MODEL, PRO_MODEL), # Explaining an output does not need the pro model
+    "error analysis": (PRO_MODEL, FLASH_MODEL),
+}
+# <file>, <remote-host>: one word, no dots or spaces, and not directly followed by a redirect target
+# (so `sort <input >out.txt` or `tr a b <in>out` are not placeholders)
+_PLACEHOLDER_PATTERN = re.compile(r"<[A-Za-z_][\w-]*>(?![\w./~$-])|\byour_\w+")
+
+def task_models(task: str) -> list[str]:
+    """Returns the models for a task ([MODELS] ASK, EXPLANATION, ERROR_ANALYSIS in config.ini: comma-separated)."""
+    configured = load_settings().get('MODELS', task.upper().replace(" ", "_"), fallback="")
+    models = [model.strip() for model in configured.split(",") if model.strip()]
+    return list(dict.fromkeys(models or DEFAULT_TASK_MODELS[task]))
+
+def is_usable_command(command: str) -> bool:
+    """A proposed command is usable if it is a single, non-empty line without placeholders like <file>."""
+    return bool(command) and "\n" not in command and not _PLACEHOLDER_PATTERN.search(command)
+
+def _needs_escalation(text: str) -> bool:
+    if text.startswith("[AI_ERROR]") or not text.strip():
+        return True
+    return text.startswith("CMD:") and not is_usable_command(text[4:].strip())
+
+def request_task_text(task: str, contents: list, **kwargs) -> str:
+    """request_ai_text with the models configured for `task`.
+
+    With [MODELS] ADAPTIVE, the fast model (FAST_MODEL) answers first; the task's own models are
+    only asked when its answer is empty, an error, or a CMD: that cannot be run as is.
+    """
+    models = task_models(task)
+    settings = load_settings()
+    fast_model = settings.get('MODELS', 'FAST_MODEL', fallback=FLASH_MODEL).strip()
+    kwargs.setdefault("label", "" if task == "ask" else task)
+    if settings.getboolean('MODELS', 'ADAPTIVE', fallback=False) and models[0] != fast_model:
+        text = request_ai_text(fast_model, contents, fallback_models=models, **kwargs)
+        if not _needs_escalation(text) or (kwargs.get("cancel") is not None and kwargs["cancel"].is_set()):
+            return text
+        if threading.current_thread() is threading.main_thread():
+            console.print(f"[dim][SYSTEM] No usable answer from {escape(fast_model)}, asking {escape(models[0])}...[/dim]")
+    return request_ai_text(models[0], contents, fallback_models=models[1:], **kwargs)
+
+def get_ai_response(user_input: str, history: list = None, verbose: bool = True, stream: bool = False) -> str:
     """
     Interacts with the Gemini API. Returns the text response or a formatted error.
+    With stream=True, a text response is rendered while it arrives (the caller must not print it again).
     """
     if history is None:
         history = []
 
-    # Prepare history for Gemini (flat list of strings)
+    # Prepare history for Gemini (flat list of strings), packed to the token budget
     flat_history = []
     flat_history.append(SYSTEM_PROMPT) # Use dynamic prompt
-
-    for entry in history[-5:]: # Limit history sent
-        if "user_input" in entry: # User query in ASK mode
-            flat_history.append(f"User (ASK): {entry['user_input']}")
-
-        if "ai_command" in entry:
-            # AI responded with a command (after an ASK query)
-            stdout_part = f"\nOutput:\n```\n{entry.get('stdout', '').strip()}\n```" if entry.get('stdout') else ""
-            stderr_part = f"\nErrors:\n```\n{entry.get('stderr', '').strip()}\n```" if entry.get('stderr') else ""
-            flat_history.append(f"Assistant (CMD:{entry['ai_command']}):{stdout_part}{stderr_part}\nReturn Code: {entry['return_code']}")
-        elif "ai_response" in entry:
-            # AI responded with text (after an ASK query)
-            flat_history.append(f"Assistant (TEXT): {entry['ai_response']}")
-        elif "ai_action" in entry and "proposed_command" in entry:
-            # Action cancelled by user (after an ASK query)
-            flat_history.append(f"Assistant: (Action cancelled by user: Proposal was 'CMD:{entry['proposed_command']}')")
-        elif "user_command" in entry: # Command executed directly in EXECUTE mode
-            stdout_part = f"\nOutput:\n```\n{entry.get('stdout', '').strip()}\n```" if entry.get('stdout') else ""
-            stderr_part = f"\nErrors:\n```\n{entry.get('stderr', '').strip()}\n```" if entry.get('stderr') else ""
-            flat_history.append(f"User (EXECUTE CMD:{entry['user_command']}):{stdout_part}{stderr_part}\nReturn Code: {entry['return_code']}")
+    if context_cache.history_prefix:
+        # Older entries stay in a frozen block so the prefix can be served from the context cache
+        frozen_lines, recent_lines = context_cache.split_history(history, prefix_tokens=estimate_tokens(SYSTEM_PROMPT))
+        flat_history.extend(frozen_lines)
+        cache_prefix = len(flat_history)
+        flat_history.extend(recent_lines)
+    else:
+        flat_history.extend(build_history_prompt(history))
+        cache_prefix = 1
 
     # Add the latest user query (ASK mode)
     flat_history.append(f"User (ASK): {user_input}")
@@ -188,116 +1841,388 @@ def get_ai_response(user_input: str, history: list = None, verbose: bool = True)
     if not verbose:
         flat_history.append("Assistant (Instruction): Respond only with 'CMD: your_exact_command'. Do not provide any explanation or additional text.")
 
-    try:
-        response = client.models.generate_content(
-            model='models/gemini-2.5-pro-exp-03-25',
-            contents=flat_history,
+    return request_task_text("ask", flat_history, stream=stream, cache_prefix=cache_prefix,
+                             header="[green]AI:[/green] ", status_message="[bold green]AI thinking...")
+
+# --- Cache persistant des réponses (explications / analyses d'erreur) ---
+def _normalize_output(output) -> str:
+    """Normalizes command output for cache keys (line endings, trailing spaces)."""
+    text = str(output) if output else ""
+    return "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").split("\n")).strip()
+
+def response_cache_key(model: str, system_prompt: str, command: str, return_code: int, stdout, stderr) -> str:
+    """Hashes everything that determines an explanation / error analysis reply."""
+    digest = hashlib.sha256()
+    for part in (model, system_prompt, command, str(return_code), _normalize_output(stdout), _normalize_output(stderr)):
+        digest.update(part.encode('utf-8', errors='replace'))
+        digest.update(b"\0") # Field separator
+    return digest.hexdigest()
+
+class ResponseCache:
+    """In-memory LRU in front of a SQLite table, with a TTL and a size limit.
+    Falls back to memory only if the database cannot be opened.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: float, max_entries: int, memory_entries: int, enabled: bool = True):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.enabled = enabled
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self._memory = OrderedDict() # key -> (created_at, response)
+        self._db = None
+        self._db_failed = False
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._db is None and not self._db_failed:
+            try:
+                _make_private_file(self.db_path) # Cached answers quote command output
+                self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+                )
+                self._db.commit()
+            except (sqlite3.Error, OSError) as e:
+                console.print(f"[magenta][SYSTEM][/magenta] Response cache disabled on disk ({e}), using memory only.")
+                self._db = None
+                self._db_failed = True
+        return self._db
+
+    def _remember(self, key: str, created_at: float, response: str) -> None:
+        self._memory[key] = (created_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[0] <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[1]
+            db = self._connection()
+            if db is not None:
+                try:
+                    row = db.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                    if row and now - row[1] <= self.ttl_seconds:
+                        db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                        db.commit()
+                        self._remember(key, row[1], row[0])
+                        self.stats["disk_hits"] += 1
+                        return row[0]
+                except sqlite3.Error:
+                    pass
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: str, response: str) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            self.stats["stores"] += 1
+            db = self._connection()
+            if db is None:
+                return
+            try:
+                db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, now, now))
+                # Drop expired entries, then the least recently used ones beyond the size limit
+                db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+                db.execute(
+                    "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                db.commit()
+            except sqlite3.Error:
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            for name in self.stats:
+                self.stats[name] = 0
+            db = self._connection()
+            if db is not None:
+                try:
+                    db.execute("DELETE FROM responses")
+                    db.commit()
+                except sqlite3.Error:
+                    pass
+
+    def memory_count(self) -> int:
+        return len(self._memory)
+
+    def disk_entries(self) -> int:
+        with self._lock:
+            db = self._connection()
+            if db is None:
+                return 0
+            try:
+                return db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            except sqlite3.Error:
+                return 0
+
+def _create_response_cache() -> ResponseCache:
+    settings = load_settings()
+    return ResponseCache(
+        db_path=os.path.join(smarterm_home, 'response_cache.sqlite3'),
+        ttl_seconds=settings.getfloat('CACHE', 'TTL_SECONDS', fallback=7 * 24 * 3600),
+        max_entries=settings.getint('CACHE', 'MAX_ENTRIES', fallback=1000),
+        memory_entries=settings.getint('CACHE', 'MEMORY_ENTRIES', fallback=128),
+        enabled=settings.getboolean('CACHE', 'ENABLED', fallback=True),
+    )
+
+response_cache = _create_response_cache()
+
+def show_cache_stats() -> None:
+    """Prints hit rates of the response cache (for the !cache command)."""
+    stats = response_cache.stats
+    hits = stats["memory_hits"] + stats["disk_hits"]
+    lookups = hits + stats["misses"]
+    hit_rate = f"{100 * hits / lookups:.0f}%" if lookups else "n/a"
+    status = "[bold green]enabled[/bold green]" if response_cache.enabled else "[bold red]disabled[/bold red]"
+    console.print(f"[magenta][SYSTEM][/magenta] Response cache {status} ([cyan]{response_cache.db_path}[/cyan])")
+    console.print(f"  Lookups: {lookups} | Hit rate: {hit_rate} (memory: {stats['memory_hits']}, disk: {stats['disk_hits']}) | Misses: {stats['misses']}")
+    console.print(f"  Entries: {response_cache.memory_count()} in memory, {response_cache.disk_entries()} on disk | Stored this session: {stats['stores']}")
+
+def _format_seconds(value: float | None) -> str:
+    return f"{value * 1000:.0f}ms" if value is not None and value < 1 else (f"{value:.2f}s" if value is not None else "n/a")
+
+def show_stats() -> None:
+    """Prints this session's latency percentiles, token spend, cache and retry counts (for the !stats command)."""
+    console.print(f"[magenta][SYSTEM][/magenta] Session stats ([cyan]{metrics.path if metrics.enabled else 'metrics file disabled'}[/cyan])")
+    rows = [("AI " + label, metrics.values("ai", "latency", label=label)) for label in dict.fromkeys(metrics.values("ai", "label"))]
+    rows.append(("AI first token", metrics.values("ai", "first_token")))
+    rows.append(("Command run", metrics.values("command", "seconds")))
+    rows.append(("Command output display", metrics.values("command", "render_seconds")))
+    rows.extend((f"Turn ({mode})", metrics.values("turn", "seconds", mode=mode)) for mode in ("EXECUTE", "ASK"))
+    for name, values in rows:
+        if values:
+            console.print(f"  {name:<24} n={len(values):<4} p50 {_format_seconds(percentile(values, 0.5)):>8} | p95 {_format_seconds(percentile(values, 0.95)):>8}")
+    input_tokens = sum(metrics.values("ai", "input_tokens"))
+    output_tokens = sum(metrics.values("ai", "output_tokens"))
+    cached_tokens = sum(metrics.values("ai", "cached_tokens"))
+    console.print(f"  Tokens: {input_tokens} in ({cached_tokens} cached) | {output_tokens} out")
+    attempts = metrics.values("ai", "attempts")
+    failures = len(metrics.values("ai", "outcome", outcome="error"))
+    console.print(f"  AI requests: {len(attempts)} | Retries: {sum(attempts) - len(attempts)} | Failed: {failures}")
+    compressed = metrics.values("compression", "original_bytes")
+    if compressed:
+        saved = sum(metrics.values("compression", "saved_bytes"))
+        console.print(f"  Output compression: {saved} of {sum(compressed)} bytes saved ({100 * saved / max(sum(compressed), 1):.0f}%) over {len(compressed)} outputs")
+    cache_actions = metrics.values("context_cache", "action")
+    if cache_actions:
+        console.print(f"  Context caches: {cache_actions.count('created')} created, {cache_actions.count('refreshed')} refreshed, {cache_actions.count('failed')} refused")
+    stats = response_cache.stats
+    hits = stats["memory_hits"] + stats["disk_hits"]
+    lookups = hits + stats["misses"]
+    console.print(f"  Response cache: {hits}/{lookups} hits" + (f" ({100 * hits / lookups:.0f}%)" if lookups else ""))
+
+def _show_cached_reply(text: str, header: str, stream: bool) -> None:
+    """In streaming mode callers do not print replies, so cached text replies are rendered here."""
+    if stream and not text.startswith("CMD:"):
+        console.print(header, end="")
+        console.print(text, markup=False, highlight=False)
+
+# --- Index local des suggestions (questions ASK déjà résolues) ---
+_QUERY_STOPWORDS = frozenset(
+    "a an the to of in on for and or with me my i how do can could you please all from by is are it this that what".split()
+)
+
+def normalize_query(query: str) -> str:
+    """Lowercases a natural-language query and keeps only its word-like tokens."""
+    return " ".join(re.findall(r"[a-z0-9_./~*-]+", query.lower()))
+
+def _query_tokens(query: str) -> frozenset:
+    return frozenset(token for token in normalize_query(query).split() if token not in _QUERY_STOPWORDS)
+
+class Suggestion(NamedTuple):
+    """A previously accepted command matching an ASK query."""
+    command: str
+    query: str  # The past query it was accepted for
+    score: float # 1.0 for a normalized exact match, token overlap (Jaccard) otherwise
+    uses: int
+    exact: bool  # Same query once normalized: the only kind of match proposed without asking the AI
+
+class SuggestionIndex:
+    """Past (query, accepted command, return code) triples, persisted in SQLite under ~/smarterm/.
+
+    Lookups try a normalized exact match first, then a token-based inverted index scored by
+    token overlap. Only commands that succeeded (return code 0) are suggested. Token overlap
+    ignores word order and stopwords ("copy a to b" vs "copy b to a"), so fuzzy matches are
+    only ever shown as candidates.
+    """
+
+    def __init__(self, db_path: str, min_score: float, max_entries: int, enabled: bool = True):
+        self.db_path = db_path
+        self.min_score = min_score
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries = None # (normalized query, command) -> [query, return_code, uses, last_used]
+        self._exact = {}     # normalized query -> keys
+        self._inverted = {}  # token -> keys
+        self._db = None
+
+    def _index(self, key: tuple, query: str) -> None:
+        self._exact.setdefault(key[0], set()).add(key)
+        for token in _query_tokens(query):
+            self._inverted.setdefault(token, set()).add(key)
+
+    def _load(self) -> None:
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            _make_private_file(self.db_path)
+            self._db = sqlite3.connect(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS suggestions ("
+                "normalized TEXT NOT NULL, query TEXT NOT NULL, command TEXT NOT NULL, return_code INTEGER NOT NULL, "
+                "uses INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (normalized, command))"
             )
+            rows = self._db.execute(
+                "SELECT normalized, query, command, return_code, uses, last_used FROM suggestions ORDER BY last_used DESC LIMIT ?",
+                (self.max_entries,),
+            ).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            console.print(f"[magenta][SYSTEM][/magenta] Suggestion index not persisted ({e}).")
+            self._db = None
+            rows = []
+        for normalized, query, command, return_code, uses, last_used in rows:
+            key = (normalized, command)
+            self._entries[key] = [query, return_code, uses, last_used]
+            self._index(key, query)
 
-        if response.text:
-            return response.text.strip()
-        else:
-            # Use Rich to display debug feedback
-            console.print(f"[magenta][SYSTEM][/magenta] DEBUG - Prompt Feedback:", response.prompt_feedback)
-            # Return a formatted error message to be displayed by the main loop
-            return "[AI_ERROR]Sorry, I could not generate a response. Check for potential safety blocks."
+    def add(self, query: str, command: str, return_code: int) -> None:
+        """Records the outcome of a command run for an ASK query."""
+        if not self.enabled:
+            return
+        self._load()
+        key = (normalize_query(query), command)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [query, return_code, 0, 0.0]
+            self._index(key, query)
+        entry[1] = return_code
+        entry[2] += 1
+        entry[3] = time.time()
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO suggestions VALUES (?, ?, ?, ?, ?, ?)", (key[0], entry[0], command, *entry[1:])
+                )
+                self._db.commit()
+            except sqlite3.Error:
+                pass
 
-    except genai.errors.ClientError as e:
-        # Specifically handle quota exhausted error
-        if "RESOURCE_EXHAUSTED" in str(e):
-            error_msg = "Google Gemini API quota exceeded. Please check your plan and billing details."
-            console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-            return f"[AI_ERROR]{error_msg}"
-        else:
-            # Other API client errors
-            error_msg = f"Gemini API client error: {e}"
-            console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-            return f"[AI_ERROR]Communication error with AI (Client)."
+    def lookup(self, query: str) -> Suggestion | None:
+        """Returns the best past command for the query, or None below MIN_SCORE."""
+        if not self.enabled:
+            return None
+        self._load()
 
-    except Exception as e:
-        # Other generic exceptions
-        error_msg = f"Unexpected error during Gemini API call: {e}"
-        # Print the system error immediately with Rich (without stderr)
-        console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-        # Return a formatted error message for the main loop
-        return f"[AI_ERROR]Unexpected communication error with AI."
+        def best(keys, score_of, exact: bool = False) -> Suggestion | None:
+            scored = [
+                (score_of(key), self._entries[key][2], self._entries[key][3], key)
+                for key in keys if self._entries[key][1] == 0
+            ]
+            if not scored:
+                return None
+            score, uses, _, key = max(scored)
+            return Suggestion(key[1], self._entries[key][0], score, uses, exact)
+
+        exact = best(self._exact.get(normalize_query(query), ()), lambda key: 1.0, exact=True)
+        if exact is not None:
+            return exact
+        tokens = _query_tokens(query)
+        if not tokens:
+            return None
+        candidates = set().union(*(self._inverted.get(token, ()) for token in tokens))
+        fuzzy = best(candidates, lambda key: len(tokens & _query_tokens(key[0])) / len(tokens | _query_tokens(key[0])))
+        return fuzzy if fuzzy is not None and fuzzy.score >= self.min_score else None
+
+def _create_suggestion_index() -> SuggestionIndex:
+    settings = load_settings()
+    return SuggestionIndex(
+        db_path=os.path.join(smarterm_home, 'suggestions.sqlite3'),
+        min_score=settings.getfloat('SUGGESTIONS', 'MIN_SCORE', fallback=0.6),
+        max_entries=settings.getint('SUGGESTIONS', 'MAX_ENTRIES', fallback=5000),
+        enabled=settings.getboolean('SUGGESTIONS', 'ENABLED', fallback=True),
+    )
+
+suggestion_index = _create_suggestion_index()
 
 # --- Nouvelle fonction pour obtenir l'explication de l'IA ---
-def get_ai_explanation(command: str, stdout: str, stderr: str, return_code: int) -> str:
-    """Asks the AI to explain the output of a command."""
+def get_ai_explanation(command: str, stdout: OutputCapture | str, stderr: OutputCapture | str, return_code: int, stream: bool = False,
+                       cancel: threading.Event | None = None) -> str:
+    """Asks the AI to explain the output of a command (rendered while it arrives if stream=True)."""
     explanation_prompt = (
         f"Can you briefly explain the output of the following command?\n\n"
         f"Command: `{command}`\n"
         f"Return Code: {return_code}\n\n"
-        f"Standard Output (stdout):\n```\n{stdout.strip() if stdout else '[Empty]'}\n```\n\n"
-        f"Standard Error (stderr):\n```\n{stderr.strip() if stderr else '[Empty]'}\n```\n\n"
+        f"Standard Output (stdout):\n```\n{output_for_prompt(stdout) or '[Empty]'}\n```\n\n"
+        f"Standard Error (stderr):\n```\n{output_for_prompt(stderr) or '[Empty]'}\n```\n\n"
         f"Explanation:"
     )
+    header = "[italic grey50]AI Explanation:[/italic grey50]\n"
 
-    try:
-        # Simplified API call, without the main conversation history
-        response = client.models.generate_content(
-            model='models/gemini-2.5-pro-exp-03-25', # Or a faster model if sufficient
-            contents=[SYSTEM_PROMPT, explanation_prompt], # Use dynamic prompt
-            # Stricter safety_settings could be added here if needed
-        )
-        if response.text:
-            return response.text.strip()
-        else:
-            console.print(f"[magenta][SYSTEM][/magenta] DEBUG - Prompt Feedback (Explanation):", response.prompt_feedback)
-            return "[AI_ERROR]Could not get an explanation."
-    except genai.errors.ClientError as e:
-        if "RESOURCE_EXHAUSTED" in str(e):
-            error_msg = "Google Gemini API quota exceeded for explanation."
-            console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-            return f"[AI_ERROR]{error_msg}"
-        else:
-            error_msg = f"API client error during explanation request: {e}"
-            console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-            return f"[AI_ERROR]Communication error for explanation (Client)."
-    except Exception as e:
-        error_msg = f"Unexpected error during explanation request: {e}"
-        console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-        return f"[AI_ERROR]Unexpected error for explanation."
+    # Identical command and output: reuse the previous explanation
+    cache_key = response_cache_key(",".join(task_models("explanation")), SYSTEM_PROMPT, command, return_code, stdout, stderr)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        _show_cached_reply(cached, header, stream)
+        return cached
+
+    # Simplified API call, without the main conversation history
+    # Stricter safety_settings could be added here if needed
+    explanation = request_task_text("explanation", [SYSTEM_PROMPT, explanation_prompt], stream=stream, cache_prefix=1,
+                                    header=header, status_message="[bold green]AI explaining...",
+                                    empty_message="Could not get an explanation.", cancel=cancel)
+    if not explanation.startswith("[AI_ERROR]"):
+        response_cache.put(cache_key, explanation)
+    return explanation
 
 # --- Nouvelle fonction pour l'analyse d'erreur par l'IA ---
-def get_ai_error_analysis(command: str, stdout: str, stderr: str, return_code: int) -> str:
-    """Asks the AI to explain a command error and suggest a correction."""
+def get_ai_error_analysis(command: str, stdout: OutputCapture | str, stderr: OutputCapture | str, return_code: int | None, stream: bool = False,
+                          cancel: threading.Event | None = None) -> str:
+    """Asks the AI to explain a command error and suggest a correction.
+    With stream=True, a text analysis is rendered while it arrives; a CMD: correction is returned as soon as it is complete.
+    return_code=None means the command is still running (speculative analysis on partial output).
+    """
     error_prompt = (
-        f"The following command failed:\n\n"
+        f"{'The following command failed' if return_code is not None else 'The following command is failing (still running, partial output)'}:\n\n"
         f"Command: `{command}`\n"
-        f"Return Code: {return_code}\n\n"
-        f"Standard Output (stdout):\n```\n{stdout.strip() if stdout else '[Empty]'}\n```\n\n"
-        f"Standard Error (stderr):\n```\n{stderr.strip() if stderr else '[None]'}\n```\n\n"
+        f"Return Code: {return_code if return_code is not None else '[Not yet known]'}\n\n"
+        f"Standard Output (stdout):\n```\n{output_for_prompt(stdout) or '[Empty]'}\n```\n\n"
+        f"Standard Error (stderr):\n```\n{output_for_prompt(stderr) or '[None]'}\n```\n\n"
         f"Can you briefly explain the cause of this error and propose a corrected command if possible? "
         f"If you propose a command, use *only* the format 'CMD: new_exact_command'. "
         f"Otherwise, just provide the explanation."
     )
+    header = "[yellow]AI Analysis:[/yellow]\n"
 
-    try:
-        # API call without conversation history for this specific task
-        response = client.models.generate_content(
-            model='models/gemini-2.5-pro-exp-03-25', # High-performance model for analysis
-            contents=[SYSTEM_PROMPT, error_prompt], # Use dynamic prompt
-        )
-        if response.text:
-            return response.text.strip()
-        else:
-            console.print(f"[magenta][SYSTEM][/magenta] DEBUG - Prompt Feedback (Error Analysis):", response.prompt_feedback)
-            return "[AI_ERROR]Could not analyze the error."
-    except genai.errors.ClientError as e:
-        if "RESOURCE_EXHAUSTED" in str(e):
-            error_msg = "Google Gemini API quota exceeded for error analysis."
-            console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-            return f"[AI_ERROR]{error_msg}"
-        else:
-            error_msg = f"API client error during error analysis: {e}"
-            console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-            return f"[AI_ERROR]Communication error for error analysis (Client)."
-    except Exception as e:
-        error_msg = f"Unexpected error during error analysis: {e}"
-        console.print(f"[bold red]ERR>[/bold red] {error_msg}", style="bold red")
-        return f"[AI_ERROR]Unexpected error for error analysis."
+    # Same failure as before: reuse the previous analysis
+    cache_key = response_cache_key(",".join(task_models("error analysis")), SYSTEM_PROMPT, command, return_code, stdout, stderr)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        _show_cached_reply(cached, header, stream)
+        return cached
+
+    # API call without conversation history for this specific task
+    analysis = request_task_text("error analysis", [SYSTEM_PROMPT, error_prompt], stream=stream, cache_prefix=1,
+                                 header=header, status_message="[bold yellow]AI analyzing error...",
+                                 empty_message="Could not analyze the error.", cancel=cancel)
+    if not analysis.startswith("[AI_ERROR]"):
+        response_cache.put(cache_key, analysis)
+    return analysis
 
 # --- ASCII Art Banner --- 
 # (Assigné à une variable pour éviter les problèmes de parsing dans les f-strings ou print multilignes)
@@ -312,8 +2237,335 @@ BANNER = r"""
                                                    
 """
 
-def main():
+# --- Analyse d'erreur spéculative (pendant l'exécution de la commande) ---
+DEFAULT_SPECULATIVE_PATTERN = r"(?i)\b(error|fatal|exception|traceback|failed|cannot|denied)\b"
+
+def speculative_analysis_enabled() -> bool:
+    """Returns whether error analysis may start on partial output ([AI] SPECULATIVE_ANALYSIS, off by default)."""
+    return load_settings().getboolean('AI', 'SPECULATIVE_ANALYSIS', fallback=False)
+
+class SpeculativeErrorAnalysis:
+    """Starts the error analysis while the command is still running.
+
+    It triggers when the output matches an error pattern or when stderr crosses a volume threshold.
+    Once the real return code is known, resolve() confirms the early analysis, or drops it
+    (command succeeded, or output kept growing) so the caller re-issues it on the full output.
+    """
+
+    def __init__(self, command: str, submit):
+        settings = load_settings()
+        self.command = command
+        self._submit = submit # submit(task, **kwargs) -> Future
+        self._pattern = re.compile(settings.get('AI', 'SPECULATIVE_PATTERN', fallback=DEFAULT_SPECULATIVE_PATTERN))
+        self._stderr_threshold = settings.getint('AI', 'SPECULATIVE_STDERR_BYTES', fallback=4096)
+        self._confirm_slack = settings.getint('AI', 'SPECULATIVE_CONFIRM_BYTES', fallback=2048)
+        self._stderr_bytes = 0
+        self._snapshot_size = 0
+        self.future = None
+
+    def observe(self, chunk: OutputChunk, captures: dict) -> None:
+        """execute_command hook: starts the analysis on the first sign of failure."""
+        if self.future is not None:
+            return
+        if chunk.stream == "stderr":
+            self._stderr_bytes += len(chunk.text)
+        if self._stderr_bytes < self._stderr_threshold and not self._pattern.search(chunk.text):
+            return
+        self._snapshot_size = len(captures["stdout"]) + len(captures["stderr"])
+        self.future = self._submit(
+            get_ai_error_analysis,
+            command=self.command, stdout=str(captures["stdout"]), stderr=str(captures["stderr"]), return_code=None,
+        )
+
+    def resolve(self, stdout: OutputCapture, stderr: OutputCapture, return_code: int):
+        """Returns the future of a still-valid early analysis, or None if a fresh one is needed."""
+        if self.future is None:
+            return None
+        if (return_code == 0 and not stderr) or len(stdout) + len(stderr) - self._snapshot_size > self._confirm_slack:
+            self.future.cancel() # False alarm, or the partial output is too stale to trust
+            return None
+        return self.future
+
+def execute_command_speculative(command: str, submit) -> tuple[OutputCapture, OutputCapture, int, object]:
+    """execute_command with optional speculative error analysis.
+    Returns stdout, stderr, return code and the future of a confirmed early analysis (or None).
+    """
+    if not speculative_analysis_enabled():
+        return (*execute_command(command), None)
+    speculation = SpeculativeErrorAnalysis(command, submit)
+    stdout, stderr, return_code = execute_command(command, on_output=speculation.observe)
+    return stdout, stderr, return_code, speculation.resolve(stdout, stderr, return_code)
+
+def show_explanation_result(explanation: str, rendered: bool = False) -> None:
+    """Prints an explanation (or its error); rendered=True means the text was already streamed."""
+    if explanation.startswith("[AI_ERROR]"):
+        error_message = explanation.replace("[AI_ERROR]", "").strip()
+        console.print(f"[bold red]Explanation Error:[/bold red] {error_message}") # Translated
+    elif not rendered:
+        console.print(f"[italic grey50]AI Explanation:[/italic grey50]\n{explanation}") # Translated
+
+def handle_error_analysis_result(ai_error_analysis_result: str, command_history: list, rendered: bool = False) -> None:
+    """Prints an error analysis, or runs the confirmation flow if it proposes a corrected command.
+    rendered=True means a text analysis was already streamed.
+    """
+    if not ai_error_analysis_result:
+        return
+    if ai_error_analysis_result.startswith("[AI_ERROR]"):
+        error_message = ai_error_analysis_result.replace("[AI_ERROR]", "").strip()
+        console.print(f"[bold red]Analysis Error:[/bold red] {error_message}") # Translated
+        # Failure to analyze is handled, no specific history entry needed here
+    elif ai_error_analysis_result.startswith("CMD:"):
+        # --- Correction proposal by AI ---
+        corrected_command = ai_error_analysis_result[4:].strip()
+        console.print("[yellow]AI suggests a correction:[/yellow]") # Translated
+        should_execute_correction, correction_to_execute = get_user_confirmation(corrected_command)
+        if should_execute_correction:
+            # Execute the correction
+            corr_stdout, corr_stderr, corr_ret_code = execute_command(correction_to_execute)
+            # Add correction attempt to history
+            command_history.append(HistoryEntry(
+                user_input="Auto-correction after error", # Translated context
+                ai_command=correction_to_execute,
+                stdout=corr_stdout,
+                stderr=corr_stderr,
+                return_code=corr_ret_code,
+            ))
+            # If the correction also fails, don't re-analyze to avoid loops
+            if corr_ret_code != 0 or corr_stderr:
+                console.print("[bold red]The proposed correction also failed.[/bold red]") # Translated
+        else:
+             # Correction refused
+            command_history.append(HistoryEntry(
+                user_input="Error analysis performed", # Translated
+                ai_action="Proposed correction refused", # Translated
+                proposed_command=corrected_command,
+            ))
+    elif not rendered:
+        # AI provided an explanation without a command
+        console.print(f"[yellow]AI Analysis:[/yellow]\n{ai_error_analysis_result}") # Translated
+         # The analysis itself isn't a loggable action like a command
+
+# --- Explications et analyses d'erreur en arrière-plan ---
+class CancellableFuture(Future):
+    """Future whose cancel() also signals the running task through cancel_event."""
+
+    def __init__(self):
+        super().__init__()
+        self.cancel_event = threading.Event()
+
+    def cancel(self) -> bool:
+        self.cancel_event.set()
+        return super().cancel()
+
+class BackgroundAIJobs:
+    """Runs explanations and error analyses in background threads so the next prompt appears immediately.
+
+    Results are printed as soon as they are ready. A proposed correction (CMD:) needs confirmation,
+    so it is kept until the main loop picks it up with pop_corrections(). Jobs still pending when
+    the user moves on are cancelled and their results dropped (the response cache keeps them).
+    Each job gets its own daemon thread, so exiting does not wait for requests still in flight.
+    Cancelling a job also sets the `cancel` event passed to its task: the request then stops
+    waiting for the rate limiter, a concurrency slot or a retry, and never delays the next one.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock() # Future.cancel() runs done callbacks in the calling thread
+        self._jobs = [] # Pending jobs: dicts with kind, command, future, cancelled
+        self._corrections = []
+        self._closed = False
+        self.prompt = "" # Current prompt markup, redrawn after a result is printed
+
+    def run(self, task, **kwargs) -> Future:
+        """Runs a task in a daemon thread without tracking it (the caller owns the returned future).
+        The task is called with cancel=<threading.Event>, set when the future is cancelled."""
+        future = CancellableFuture()
+        kwargs["cancel"] = future.cancel_event
+        if self._closed:
+            future.cancel()
+            return future
+
+        def work():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = task(**kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        threading.Thread(target=work, name="smarterm-ai", daemon=True).start()
+        return future
+
+    def submit(self, kind: str, command_info: dict) -> None:
+        task = get_ai_error_analysis if kind == "analysis" else get_ai_explanation
+        self.adopt(kind, command_info["command"], self.run(task, **command_info))
+
+    def adopt(self, kind: str, command: str, future) -> None:
+        """Tracks an already running request: its result is printed when ready."""
+        job = {"kind": kind, "command": command, "future": future, "cancelled": False}
+        with self._lock:
+            self._jobs.append(job)
+        future.add_done_callback(lambda done: self._on_done(job, done))
+
+    def _on_done(self, job: dict, future) -> None:
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+            if job["cancelled"] or future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                result = f"[AI_ERROR]Unexpected error in background request: {e}"
+            console.print()
+            if job["kind"] == "explanation":
+                show_explanation_result(result)
+            elif result.startswith("CMD:"):
+                self._corrections.append(result)
+                console.print(f"[yellow]AI has a correction for[/yellow] [bold]{job['command']}[/bold][yellow]. Press Enter to review it.[/yellow]")
+            else:
+                handle_error_analysis_result(result, [])
+            console.print(self.prompt, end="")
+
+    def pop_corrections(self) -> list[str]:
+        with self._lock:
+            corrections, self._corrections = self._corrections, []
+        return corrections
+
+    def cancel_pending(self, announce: bool = True) -> None:
+        """Called when the user moves on: drops pending jobs and unreviewed corrections."""
+        with self._lock:
+            for job in list(self._jobs):
+                job["cancelled"] = True
+                if not job["future"].cancel() and announce:
+                    console.print(f"[dim][SYSTEM] Background {job['kind']} for '{escape(job['command'])}' cancelled.[/dim]")
+            self._jobs.clear()
+            self._corrections.clear()
+
+    def shutdown(self) -> None:
+        self._closed = True
+        self.cancel_pending(announce=False)
+
+def ai_background_enabled() -> bool:
+    """Returns whether explanations and error analyses run in the background ([AI] BACKGROUND, on by default)."""
+    return load_settings().getboolean('AI', 'BACKGROUND', fallback=True)
+
+# --- Mode batch (sans interface interactive) ---
+def _read_batch_tasks(path: str) -> list[dict]:
+    """Reads a JSONL file of tasks: {"query": "...", "id": ...} objects or bare JSON strings."""
+    tasks = []
+    with open(path, encoding='utf-8') if path != "-" else nullcontext(sys.stdin) as handle:
+        for line_number, line in enumerate(handle, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            task = {"id": line_number}
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                task["error"] = f"Invalid JSON: {e}"
+                tasks.append(task)
+                continue
+            if isinstance(item, str):
+                task["query"] = item
+            elif isinstance(item, dict) and isinstance(item.get("query", item.get("task")), str):
+                task.update(item)
+                task["query"] = item.get("query", item.get("task"))
+            else:
+                task["error"] = "Expected a string or an object with a 'query' field."
+            tasks.append(task)
+    return tasks
+
+def _resolve_batch_task(task: dict) -> dict:
+    """Turns one natural-language task into a command (runs on the batch worker pool)."""
+    result = {key: value for key, value in task.items() if key != "error"}
+    if "error" in task:
+        result["error"] = task["error"]
+        return result
+    started_at = time.perf_counter()
+    ai_output = get_ai_response(task["query"], [], verbose=False)
+    result["latency"] = round(time.perf_counter() - started_at, 3)
+    if ai_output.startswith("[AI_ERROR]"):
+        result["error"] = ai_output.replace("[AI_ERROR]", "").strip()
+    elif ai_output.startswith("CMD:"):
+        result["command"] = ai_output[4:].strip()
+    else:
+        result["response"] = ai_output
+    return result
+
+def run_batch(args: argparse.Namespace) -> int:
+    """Resolves every task of args.batch concurrently and writes one JSON result per line.
+
+    Requests go through a pool of args.concurrency workers (the shared rate limiter still applies).
+    Results are written in input order, or as they complete with --unordered. With --execute,
+    proposed commands are run (one at a time) and their outputs added to the results.
+    Returns the process exit code (1 if any task failed).
+    """
+    output = open(args.output, "w", encoding='utf-8') if args.output else sys.stdout
+    if output is sys.stdout:
+        console.file = sys.stderr # Keep stdout clean for the JSONL results
+    failures = 0
+
+    def emit(result: dict) -> None:
+        nonlocal failures
+        if args.execute and "command" in result:
+            stdout, stderr, return_code = execute_command(result["command"])
+            result.update({"stdout": str(stdout), "stderr": str(stderr), "return_code": return_code})
+            if return_code != 0:
+                failures += 1
+        if "error" in result:
+            failures += 1
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+
+    try:
+        tasks = _read_batch_tasks(args.batch)
+        with ThreadPoolExecutor(max_workers=max(args.concurrency, 1), thread_name_prefix="smarterm-batch") as pool:
+            futures = [pool.submit(_resolve_batch_task, task) for task in tasks]
+            for future in (as_completed(futures) if args.unordered else futures):
+                emit(future.result())
+    except OSError as e:
+        console.print(f"[bold red]Error:[/bold red] {e}")
+        return 2
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    console.print(f"[magenta][SYSTEM][/magenta] Batch finished: {len(tasks)} task(s), {failures} failure(s).")
+    return 1 if failures else 0
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parses the command-line options."""
+    parser = argparse.ArgumentParser(prog="smarterm", description="Your intelligent terminal assistant powered by Google Gemini.")
+    parser.add_argument("--startup-profile", action="store_true", help="report the time spent in each startup phase before the first prompt")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="SESSION", help="continue a previous session (default: the latest) with its history as context")
+    batch = parser.add_argument_group("batch mode")
+    batch.add_argument("--batch", metavar="INPUT.jsonl", help="resolve natural-language tasks from a JSONL file ('-' for stdin) without the interactive prompt")
+    batch.add_argument("--output", metavar="OUTPUT.jsonl", help="write batch results to this file instead of stdout")
+    batch.add_argument("--concurrency", type=int, default=4, help="maximum number of tasks resolved in parallel (default: 4)")
+    batch.add_argument("--unordered", action="store_true", help="write results as they complete instead of in input order")
+    batch.add_argument("--execute", action="store_true", help="run the proposed commands (default: dry run)")
+    return parser.parse_args(argv)
+
+def show_startup_profile() -> None:
+    """Prints the time-to-first-prompt breakdown collected in startup_phases."""
+    console.print("[magenta][SYSTEM][/magenta] Startup profile:")
+    for phase, seconds in list(startup_phases):
+        console.print(f"  {phase:<45} {seconds * 1000:8.1f} ms")
+    if not any(phase.startswith("Gemini SDK") for phase, _ in startup_phases):
+        console.print(f"  {'Gemini SDK + client warm-up (background)':<45} [dim]still running / disabled[/dim]")
+
+def main(argv: list[str] | None = None):
     """Main loop of the terminal with modes, verbosity, Rich UI, and error handling."""
+    args = parse_args(argv)
+    if args.batch:
+        sys.exit(run_batch(args))
+
+    phase_started_at = time.perf_counter()
+    startup_phases.append(("Module import", phase_started_at - _process_started_at))
+
+    # Import the Gemini SDK and create the client while the banner prints
+    start_client_warm_up()
 
     # --- Initial Screen Clear ---
     os_name = platform.system()
@@ -321,6 +2573,8 @@ def main():
         os.system('cls')
     else:
         os.system('clear')
+    startup_phases.append(("Screen clear", time.perf_counter() - phase_started_at))
+    phase_started_at = time.perf_counter()
 
     # --- Display Banner ---
     console.print(f"[bold cyan]{BANNER}[/bold cyan]")
@@ -336,20 +2590,35 @@ def main():
     console.print("[cyan]  '!!'       [/cyan]: Switch mode (EXECUTE/ASK)")
     console.print("[cyan]  '!verbose' [/cyan] or [cyan]'!v'[/cyan]: Toggle verbose mode (explanations ON[bold green]V[/bold green]/OFF)")
     console.print("[cyan]  '!clear'   [/cyan] or [cyan]'!cls'[/cyan]: Clear screen")
+    console.print("[cyan]  '!cache'   [/cyan] or [cyan]'!cache clear'[/cyan]: Show response cache hit rates / clear it")
+    console.print("[cyan]  '!stats'   [/cyan]: Show latency, token and retry stats for this session")
     console.print("[cyan]  'exit' [/cyan] or [cyan]'!q' [/cyan]: Quit")
 
-    command_history = []
+    command_history = open_session_history(args.resume)
     mode = "EXECUTE"
     verbose_mode = True
+    streaming = ai_streaming_enabled()
+    background_ai = ai_background_enabled()
+    background_jobs = BackgroundAIJobs()
     # os_name already detected for initial clear
 
+    startup_phases.append(("Banner", time.perf_counter() - phase_started_at))
+    startup_phases.append(("Time to first prompt (total)", time.perf_counter() - _process_started_at))
+    if args.startup_profile:
+        show_startup_profile()
+
     while True:
         try:
             verbose_indicator = "[bold green]V[/bold green]" if verbose_mode else " "
             mode_indicator = "[bold blue]E[/bold blue]" if mode == "EXECUTE" else "[bold yellow]A[/bold yellow]"
             prompt_prefix = f"({mode_indicator}{verbose_indicator}) > "
 
+            # Corrections proposed by background error analyses go through confirmation first
+            for correction in background_jobs.pop_corrections():
+                handle_error_analysis_result(correction, command_history)
+
             # Use Prompt.ask for main input
+            background_jobs.prompt = f"[cyan]{prompt_prefix}[/cyan]: "
             user_input = Prompt.ask(f"[cyan]{prompt_prefix}[/cyan]", default="", show_default=False).strip()
 
             # --- Internal Special Commands ---
@@ -369,6 +2638,19 @@ def main():
                 console.print(f"[magenta][SYSTEM][/magenta] Verbose mode {status}.")
                 continue
 
+            if input_lower == '!cache':
+                show_cache_stats()
+                continue
+
+            if input_lower == '!stats':
+                show_stats()
+                continue
+
+            if input_lower == '!cache clear':
+                response_cache.clear()
+                console.print("[magenta][SYSTEM][/magenta] Response cache cleared.")
+                continue
+
             if input_lower in ['!clear', '!cls']:
                 if os_name == "Windows":
                     os.system('cls')
@@ -384,112 +2666,129 @@ def main():
                 console.print("[cyan]  '!!'       [/cyan]: Switch mode (EXECUTE/ASK)")
                 console.print("[cyan]  '!verbose' [/cyan] or [cyan]'!v'[/cyan]: Toggle verbose mode (explanations ON[bold green]V[/bold green]/OFF)")
                 console.print("[cyan]  '!clear'   [/cyan] or [cyan]'!cls'[/cyan]: Clear screen")
+                console.print("[cyan]  '!cache'   [/cyan] or [cyan]'!cache clear'[/cyan]: Show response cache hit rates / clear it")
+                console.print("[cyan]  '!stats'   [/cyan]: Show latency, token and retry stats for this session")
                 console.print("[cyan]  'exit' [/cyan] or [cyan]'!q' [/cyan]: Quit")
                 continue # Move to the next loop iteration
 
             if not user_input:
                 continue
 
+            # The user moved on: results for the previous command are no longer wanted
+            background_jobs.cancel_pending()
+            turn_started_at = time.perf_counter()
+
             # --- Logic based on mode ---
             executed_command_info = None
             command_failed = False
+            early_analysis = None # Error analysis started while the command was running
             ai_error_analysis_result = None
 
             if mode == "EXECUTE":
                 # --- Direct execution ---
-                stdout, stderr, return_code = execute_command(user_input)
+                stdout, stderr, return_code, early_analysis = execute_command_speculative(user_input, background_jobs.run)
                 executed_command_info = {"command": user_input, "stdout": stdout, "stderr": stderr, "return_code": return_code}
-                command_history.append({"user_command": user_input, "stdout": stdout, "stderr": stderr, "return_code": return_code})
+                command_history.append(HistoryEntry(user_command=user_input, stdout=stdout, stderr=stderr, return_code=return_code))
                 if return_code != 0 or stderr:
                     command_failed = True
 
             elif mode == "ASK":
+                # --- Local suggestions: commands already accepted for the same kind of query ---
+                ai_output = None
+                confirmed_command = None # Set when a history suggestion was confirmed already
+                history_hit = suggestion_index.lookup(user_input)
+                if history_hit and history_hit.exact:
+                    console.print(f"[magenta][SYSTEM][/magenta] Same question as before: command from your history (used {history_hit.uses}x). Ctrl+C to ask the AI instead.")
+                    should_execute, confirmed_command = get_user_confirmation(history_hit.command)
+                    if should_execute:
+                        ai_output = f"CMD:{confirmed_command}"
+                elif history_hit:
+                    console.print(f"[dim]Candidate from history ({history_hit.score:.0%} match with '{escape(history_hit.query)}'): {escape(history_hit.command)}[/dim]")
+
                 # --- AI Interaction ---
-                with console.status("[bold green]AI thinking..."): # Translated
-                    ai_output = get_ai_response(user_input, command_history, verbose=verbose_mode)
+                if ai_output is None:
+                    # In streaming mode, get_ai_response shows its own spinner until the first tokens
+                    with nullcontext() if streaming else console.status("[bold green]AI thinking..."): # Translated
+                        ai_output = get_ai_response(user_input, command_history, verbose=verbose_mode, stream=streaming)
+                    if ai_output.startswith("[AI_ERROR]") and history_hit:
+                        # Offline fallback: the AI is unreachable but history has a candidate
+                        console.print(f"[bold red]AI Error:[/bold red] {ai_output.replace('[AI_ERROR]', '').strip()}")
+                        console.print("[magenta][SYSTEM][/magenta] Falling back to the candidate from your history.")
+                        ai_output = f"CMD:{history_hit.command}"
+                    confirmed_command = None
 
                 if ai_output.startswith("[AI_ERROR]"):
                     error_message = ai_output.replace("[AI_ERROR]", "").strip()
                     console.print(f"[bold red]AI Error:[/bold red] {error_message}") # Translated
-                    command_history.append({"user_input": user_input, "ai_response": f"ERROR: {error_message}"})
+                    command_history.append(HistoryEntry(user_input=user_input, ai_response=f"ERROR: {error_message}"))
 
                 elif ai_output.startswith("CMD:"):
                     # --- Command proposal by AI ---
                     proposed_command = ai_output[4:].strip()
-                    should_execute, command_to_execute = get_user_confirmation(proposed_command)
+                    if confirmed_command is not None:
+                        should_execute, command_to_execute = True, confirmed_command
+                    else:
+                        should_execute, command_to_execute = get_user_confirmation(proposed_command)
 
                     if should_execute:
-                        stdout, stderr, return_code = execute_command(command_to_execute)
+                        stdout, stderr, return_code, early_analysis = execute_command_speculative(command_to_execute, background_jobs.run)
                         executed_command_info = {"command": command_to_execute, "stdout": stdout, "stderr": stderr, "return_code": return_code}
-                        command_history.append({"user_input": user_input, "ai_command": command_to_execute, "stdout": stdout, "stderr": stderr, "return_code": return_code})
+                        command_history.append(HistoryEntry(user_input=user_input, ai_command=command_to_execute, stdout=stdout, stderr=stderr, return_code=return_code))
+                        suggestion_index.add(user_input, command_to_execute, return_code)
                         if return_code != 0 or stderr:
                             command_failed = True
                     else:
                         # Command cancelled in get_user_confirmation, message already printed
-                        command_history.append({"user_input": user_input, "ai_action": "Proposed command cancelled", "proposed_command": proposed_command})
+                        command_history.append(HistoryEntry(user_input=user_input, ai_action="Proposed command cancelled", proposed_command=proposed_command))
                 else:
-                    # --- Text response from AI ---
-                    console.print(f"[green]AI:[/green] {ai_output}") # Translated
-                    command_history.append({"user_input": user_input, "ai_response": ai_output})
+                    # --- Text response from AI (already rendered while streaming) ---
+                    if not streaming:
+                        console.print(f"[green]AI:[/green] {ai_output}") # Translated
+                    command_history.append(HistoryEntry(user_input=user_input, ai_response=ai_output))
 
             # --- Post-Execution Error Analysis (if failed) ---
-            if command_failed and executed_command_info:
-                console.print("[yellow]Analyzing error with AI...[/yellow]") # Translated
-                with console.status("[bold yellow]AI analyzing error..."): # Translated
-                    ai_error_analysis_result = get_ai_error_analysis(**executed_command_info)
-
-                if ai_error_analysis_result:
-                    if ai_error_analysis_result.startswith("[AI_ERROR]"):
-                        error_message = ai_error_analysis_result.replace("[AI_ERROR]", "").strip()
-                        console.print(f"[bold red]Analysis Error:[/bold red] {error_message}") # Translated
-                        # Failure to analyze is handled, no specific history entry needed here
-                    elif ai_error_analysis_result.startswith("CMD:"):
-                        # --- Correction proposal by AI ---
-                        corrected_command = ai_error_analysis_result[4:].strip()
-                        console.print("[yellow]AI suggests a correction:[/yellow]") # Translated
-                        should_execute_correction, correction_to_execute = get_user_confirmation(corrected_command)
-                        if should_execute_correction:
-                            # Execute the correction
-                            corr_stdout, corr_stderr, corr_ret_code = execute_command(correction_to_execute)
-                            # Add correction attempt to history
-                            command_history.append({
-                                "user_input": "Auto-correction after error", # Translated context
-                                "ai_command": correction_to_execute,
-                                "stdout": corr_stdout,
-                                "stderr": corr_stderr,
-                                "return_code": corr_ret_code
-                            })
-                            # If the correction also fails, don't re-analyze to avoid loops
-                            if corr_ret_code != 0 or corr_stderr:
-                                console.print("[bold red]The proposed correction also failed.[/bold red]") # Translated
-                        else:
-                             # Correction refused
-                            command_history.append({
-                                "user_input": "Error analysis performed", # Translated
-                                "ai_action": "Proposed correction refused", # Translated
-                                "proposed_command": corrected_command
-                            })
-                    else:
-                        # AI provided an explanation without a command
-                        console.print(f"[yellow]AI Analysis:[/yellow]\n{ai_error_analysis_result}") # Translated
-                         # The analysis itself isn't a loggable action like a command
+            if executed_command_info and not ai_available():
+                pass # The AI setup error was already reported once: no automatic explanation or analysis
+            elif command_failed and executed_command_info and early_analysis is not None:
+                console.print("[yellow]Using the error analysis started while the command was running...[/yellow]")
+                if background_ai:
+                    background_jobs.adopt("analysis", executed_command_info["command"], early_analysis)
+                else:
+                    with console.status("[bold yellow]AI analyzing error..."):
+                        ai_error_analysis_result = early_analysis.result()
+                    handle_error_analysis_result(ai_error_analysis_result, command_history)
+
+            elif command_failed and executed_command_info:
+                if background_ai:
+                    console.print("[yellow]Analyzing error with AI in the background...[/yellow]")
+                    background_jobs.submit("analysis", executed_command_info)
+                else:
+                    console.print("[yellow]Analyzing error with AI...[/yellow]") # Translated
+                    with nullcontext() if streaming else console.status("[bold yellow]AI analyzing error..."): # Translated
+                        ai_error_analysis_result = get_ai_error_analysis(**executed_command_info, stream=streaming)
+                    handle_error_analysis_result(ai_error_analysis_result, command_history, rendered=streaming)
 
             # --- Post-Execution Explanation (if success AND verbose) ---
             elif not command_failed and verbose_mode and executed_command_info:
-                console.print("[grey50]Getting explanation from AI...[/grey50]") # Translated
-                with console.status("[bold green]AI explaining..."): # Translated
-                    explanation = get_ai_explanation(**executed_command_info)
-                if explanation.startswith("[AI_ERROR]"):
-                    error_message = explanation.replace("[AI_ERROR]", "").strip()
-                    console.print(f"[bold red]Explanation Error:[/bold red] {error_message}") # Translated
+                if background_ai:
+                    console.print("[grey50]Getting explanation from AI in the background...[/grey50]")
+                    background_jobs.submit("explanation", executed_command_info)
                 else:
-                    console.print(f"[italic grey50]AI Explanation:[/italic grey50]\n{explanation}") # Translated
+                    console.print("[grey50]Getting explanation from AI...[/grey50]") # Translated
+                    with nullcontext() if streaming else console.status("[bold green]AI explaining..."): # Translated
+                        explanation = get_ai_explanation(**executed_command_info, stream=streaming)
+                    show_explanation_result(explanation, rendered=streaming)
+
+            metrics.record("turn", mode=mode, seconds=round(time.perf_counter() - turn_started_at, 4))
 
         except EOFError:
             break
         except KeyboardInterrupt:
             console.print(f"\n[magenta][SYSTEM][/magenta] Interruption received. Type 'exit' or '!q' to quit.") # Translated
 
+    background_jobs.shutdown()
+    if command_history.log is not None:
+        command_history.log.close()
     console.print(f"\n[magenta][SYSTEM][/magenta] Goodbye!") # Translated
 
 if __name__ == "__main__":